@@ -0,0 +1,339 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from urllib.parse import quote
+from urllib.request import urlopen
+
+from SAR_lib import SAR_Project
+from SAR_storage import load_index, save_index
+
+try:
+    import resource
+except ImportError:
+    #Windows no tiene el modulo resource, no se mide la memoria
+    resource = None
+
+
+def best_time(fnc, repeat=5):
+    """
+    Devuelve el mejor tiempo medio por llamada de "fnc", en segundos.
+    """
+    timer = timeit.Timer(fnc)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def bench_and(searcher, field, pairs):
+    """
+    Micro-benchmark de la interseccion de posting lists: compara el recorrido lineal
+    (merge_and_posting) con el galloping (gallop_and_posting) y con and_posting, que elige
+    entre los dos segun la proporcion de longitudes.
+
+    param:
+        -searcher: SAR_Project con el indice cargado
+        -field: campo del que se sacan las posting lists
+        -pairs: lista de parejas de terminos, si esta vacia se generan parejas descompensadas
+                con el termino mas frecuente
+    """
+    index = searcher.index[field]
+    if not pairs:
+        #Termino mas frecuente frente a terminos de frecuencias cada vez mas bajas
+        by_len = sorted(index, key=lambda t: len(index[t]), reverse=True)
+        common = by_len[0]
+        for n in (2, 8, 32, 128, 512):
+            target = len(index[common]) // n
+            rare = min(by_len[1:], key=lambda t: abs(len(index[t]) - target))
+            pairs.append((common, rare))
+    print("%-25s %7s %7s %7s %10s %10s %10s %8s" % ('pair', 'len1', 'len2', 'ratio',
+                                                   'merge(us)', 'gallop(us)', 'and(us)', 'speedup'))
+    for t1, t2 in pairs:
+        p1 = index.get(t1, [])
+        p2 = index.get(t2, [])
+        linear = best_time(lambda: searcher.merge_and_posting(p1, p2))
+        gallop = best_time(lambda: searcher.gallop_and_posting(*sorted((p1, p2), key=len)))
+        adaptive = best_time(lambda: searcher.and_posting(p1, p2))
+        ratio = max(len(p1), len(p2)) / max(1, min(len(p1), len(p2)))
+        print("%-25s %7d %7d %7.1f %10.1f %10.1f %10.1f %7.1fx" % (t1 + ' AND ' + t2, len(p1), len(p2), ratio,
+              linear * 1e6, gallop * 1e6, adaptive * 1e6, linear / adaptive))
+
+
+def linear_permu(searcher, term, field):
+    """
+    Busqueda de terminos por permuterm recorriendo todas las rotaciones, como se hacia
+    antes de ordenarlas. Solo sirve como referencia para bench_wildcard.
+    """
+    term = term + '$'
+    while term[-1] != '?' and term[-1] != '*':
+        term = term[1:] + term[0]
+    claves = [t for t in searcher.ptindex[field] if term[:-1] == t[:len(term[:-1])]]
+    if '?' == term[-1]:
+        claves = [t for t in claves if len(t) == len(term)]
+    return claves
+
+
+def bench_wildcard(searcher, queries):
+    """
+    Benchmark de las consultas con comodines: tiempo de buscar los terminos en el indice
+    permuterm ordenado (obtener_claves_permu) frente a recorrerlo entero, y tiempo de la
+    consulta completa (get_permuterm, con el OR de las posting lists).
+
+    param:
+        -searcher: SAR_Project con el indice permuterm cargado
+        -queries: lista de terminos con comodines, pueden llevar delante el campo
+    """
+    print("%-20s %7s %12s %12s %8s %12s" % ('query', 'terms', 'linear(us)', 'sorted(us)',
+                                           'speedup', 'posting(us)'))
+    for query in queries:
+        field, term = ('article', query) if ':' not in query else query.rsplit(':', 1)
+        terms = searcher.obtener_claves_permu(term, field)
+        linear = best_time(lambda: linear_permu(searcher, term, field), repeat=3)
+        lookup = best_time(lambda: searcher.obtener_claves_permu(term, field))
+        posting = best_time(lambda: searcher.get_permuterm(term, field))
+        print("%-20s %7d %12.1f %12.1f %7.0fx %12.1f" % (query, len(terms), linear * 1e6, lookup * 1e6,
+                                                       linear / lookup, posting * 1e6))
+
+
+def percentile(values, p):
+    """
+    Percentil "p" (de 0 a 100) de una lista ordenada de valores, por el metodo del rango mas cercano.
+    """
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+def bench_server(url, queries, endpoint, clients, requests):
+    """
+    Prueba de carga del servidor de busqueda (SAR_Server.py): "clients" clientes concurrentes
+    lanzan "requests" peticiones en total repartiendo las queries de forma ciclica.
+
+    param:
+        -url: direccion del servidor
+        -queries: lista de queries
+        -endpoint: 'search' o 'count'
+        -clients: nº de clientes concurrentes
+        -requests: nº total de peticiones
+    """
+    urls = ['%s/%s?q=%s' % (url.rstrip('/'), endpoint, quote(q)) for q in queries]
+
+    def request(i):
+        t0 = time.perf_counter()
+        with urlopen(urls[i % len(urls)]) as response:
+            response.read()
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        latencies = sorted(executor.map(request, range(requests)))
+    total = time.perf_counter() - t0
+    print("%8s %8s %10s %10s %10s %10s" % ('clients', 'requests', 'p50(ms)', 'p99(ms)', 'max(ms)', 'QPS'))
+    print("%8d %8d %10.2f %10.2f %10.2f %10.1f" % (clients, requests, percentile(latencies, 50) * 1e3,
+          percentile(latencies, 99) * 1e3, latencies[-1] * 1e3, requests / total))
+
+
+def read_queries(filename):
+    """
+    Lee un fichero de queries, una por linea, saltando las lineas vacias y las que empiezan por #.
+    Las listas de test tienen la query y el resultado separados por tabulador, se queda solo la query.
+    """
+    with open(filename, encoding='utf-8') as fh:
+        return [line.split('\t')[0] for line in fh.read().split('\n') if line and not line.startswith('#')]
+
+
+# modos de indexacion del benchmark completo: letras de las opciones de SAR_Indexer.py
+SUITE_MODES = ('', 'S', 'P', 'M', 'O', 'SPMO')
+
+
+def index_mode(newsdir, mode, workdir):
+    """
+    Indexa "newsdir" con las opciones de "mode" y mide el tiempo, el tamaño del indice en los dos formatos,
+    el tiempo de cargarlo y el pico de memoria. Se ejecuta en un proceso nuevo para cada modo,
+    asi el pico de memoria es solo el de ese modo.
+
+    param:
+        -newsdir: directorio con las noticias
+        -mode: letras de las opciones de SAR_Indexer.py (S, P, M, O)
+        -workdir: directorio en el que se guardan los indices
+    return:
+        -diccionario con las medidas
+    """
+    indexfile = os.path.join(workdir, 'index_%s.bin' % (mode or 'base'))
+    indexer = SAR_Project()
+    files = indexer.list_files(newsdir)
+    size = sum(os.path.getsize(f) for f in files)
+    t0 = time.perf_counter()
+    indexer.index_dir(newsdir, stem='S' in mode, permuterm='P' in mode, multifield='M' in mode,
+                      positional='O' in mode, docstore=indexfile + '.docs')
+    elapsed = time.perf_counter() - t0
+    stats = {'files': len(files), 'news': len(indexer.news), 'input_mb': size / 2**20,
+             'index_s': elapsed, 'docs_per_s': len(indexer.news) / elapsed, 'mb_per_s': size / 2**20 / elapsed,
+             'docstore_bytes': os.path.getsize(indexfile + '.docs')}
+    for fmt in ('mmap', 'pickle'):
+        filename = indexfile if fmt == 'mmap' else indexfile + '.pkl'
+        t0 = time.perf_counter()
+        save_index(indexer, filename, fmt)
+        stats[fmt + '_save_s'] = time.perf_counter() - t0
+        stats[fmt + '_bytes'] = os.path.getsize(filename)
+        stats[fmt + '_load_s'] = best_time(lambda: load_index(filename), repeat=3)
+    if resource is not None:
+        #ru_maxrss esta en KB en Linux y en bytes en macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        stats['peak_rss_mb'] = rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+    return stats
+
+
+def query_category(query):
+    """
+    Clasifica una query del fichero de test: comodines, campos, parentesis, operadores o termino simple.
+    """
+    if '*' in query or '?' in query:
+        return 'wildcard'
+    if ':' in query:
+        return 'field'
+    if '(' in query:
+        return 'parenthesized'
+    if any(op in query.split() for op in ('AND', 'OR', 'NOT')):
+        return 'boolean'
+    return 'term'
+
+
+def latency_stats(times):
+    """
+    Resumen de una lista de tiempos en segundos: nº de medidas, media y percentiles en microsegundos.
+    """
+    times = sorted(times)
+    return {'n': len(times), 'mean_us': sum(times) / len(times) * 1e6, 'p50_us': percentile(times, 50) * 1e6,
+            'p90_us': percentile(times, 90) * 1e6, 'p99_us': percentile(times, 99) * 1e6, 'max_us': times[-1] * 1e6}
+
+
+def bench_queries(searcher, queries, repeat):
+    """
+    Mide la latencia de cada query, sin cache de resultados, agrupadas por tipo (ver query_category).
+    Las queries de terminos simples se miden tambien con stemming, en la categoria 'stem'.
+
+    param:
+        -searcher: SAR_Project con el indice completo (-S -P -M -O)
+        -queries: lista de queries
+        -repeat: nº de veces que se resuelve cada query
+    return:
+        -diccionario categoria --> resumen de latencias (ver latency_stats)
+    """
+    searcher.set_query_cache(0)
+    times = {}
+    for stem in (False, True):
+        searcher.set_stemming(stem)
+        for query in queries:
+            category = query_category(query)
+            if stem:
+                if category != 'term':
+                    continue
+                category = 'stem'
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                searcher.solve_query(query)
+                times.setdefault(category, []).append(time.perf_counter() - t0)
+    return {category: latency_stats(t) for category, t in times.items()}
+
+
+def bench_suite(newsdir, queries, modes, repeat, workdir):
+    """
+    Benchmark completo y reproducible: indexacion de cada modo, tamaño y carga de los indices
+    y latencia de las queries sobre el indice completo.
+
+    param:
+        -newsdir: directorio con las noticias
+        -queries: lista de queries
+        -modes: modos de indexacion (ver SUITE_MODES)
+        -repeat: nº de veces que se resuelve cada query
+        -workdir: directorio en el que se guardan los indices
+    return:
+        -diccionario con todas las medidas, para guardarlo en JSON
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    results = {'corpus': newsdir, 'commit': commit, 'python': platform.python_version(),
+               'platform': platform.platform(), 'indexing': {}}
+    if 'SPMO' not in modes:
+        modes = list(modes) + ['SPMO']
+    for mode in modes:
+        #Un proceso nuevo por modo, asi no se acumula la memoria de los anteriores
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results['indexing'][mode or 'base'] = executor.submit(index_mode, newsdir, mode, workdir).result()
+    searcher = load_index(os.path.join(workdir, 'index_SPMO.bin'))
+    results['queries'] = bench_queries(searcher, queries, repeat)
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the search engine.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    parser_and = subparsers.add_parser('and', help='micro-benchmark of posting list intersection.')
+    parser_and.add_argument('index', metavar='index', type=str,
+                    help='name of the file with the index object.')
+    parser_and.add_argument('-f', '--field', dest='field', type=str, default='article',
+                    help='field to take the posting lists from.')
+    parser_and.add_argument('pairs', metavar='term1:term2', type=str, nargs='*',
+                    help='pairs of terms to intersect. By default, skewed pairs with the most frequent term.')
+
+    parser_wildcard = subparsers.add_parser('wildcard', help='benchmark of wildcard queries with the permuterm index.')
+    parser_wildcard.add_argument('index', metavar='index', type=str,
+                    help='name of the file with the index object, built with -P.')
+    parser_wildcard.add_argument('queries', metavar='query', type=str, nargs='*',
+                    default=['c*sa', 'c?sa', 'bar*na', 'val*cia', 'pa*s', 'ma?a', '*ción', 'des*', 'date:201*10'],
+                    help='terms with wildcards, optionally prefixed by the field.')
+
+    parser_server = subparsers.add_parser('server', help='load test of the search server (SAR_Server.py).')
+    parser_server.add_argument('url', metavar='url', type=str, nargs='?', default='http://127.0.0.1:8080',
+                    help='address of the running server.')
+    parser_server.add_argument('-L', '--list', dest='qlist', metavar='qlist', type=str, required=True,
+                    help='file with queries, one per line. Lines starting with # are skipped.')
+    parser_server.add_argument('-e', '--endpoint', dest='endpoint', choices=('search', 'count'), default='search',
+                    help='endpoint to query.')
+    parser_server.add_argument('-c', '--clients', dest='clients', type=int, default=8,
+                    help='number of concurrent clients.')
+    parser_server.add_argument('-n', '--requests', dest='requests', type=int, default=1000,
+                    help='total number of requests.')
+
+    parser_suite = subparsers.add_parser('suite', help='indexing, index size, loading and query latency, as JSON.')
+    parser_suite.add_argument('newsdir', metavar='newsdir', type=str,
+                    help='directory with the news, for example 2015.')
+    parser_suite.add_argument('-L', '--list', dest='qlist', metavar='qlist', type=str, required=True,
+                    help='file with queries, for example result_2015_full_stemming.txt.')
+    parser_suite.add_argument('-m', '--modes', dest='modes', type=str, nargs='*', default=list(SUITE_MODES),
+                    help='indexing modes, as the letters of the SAR_Indexer.py options (S, P, M, O), '
+                         '"base" for no options. The full mode SPMO is always included, the queries run on it.')
+    parser_suite.add_argument('-r', '--repeat', dest='repeat', type=int, default=20,
+                    help='number of times each query is solved.')
+    parser_suite.add_argument('-o', '--output', dest='output', type=str, default=None,
+                    help='file to write the JSON results to. By default, standard output.')
+
+    args = parser.parse_args()
+
+    if args.bench == 'server':
+        bench_server(args.url, read_queries(args.qlist), args.endpoint, args.clients, args.requests)
+    elif args.bench == 'suite':
+        with tempfile.TemporaryDirectory() as workdir:
+            modes = ['' if m == 'base' else ''.join(sorted(m.upper(), key='SPMO'.index)) for m in args.modes]
+            results = bench_suite(args.newsdir, read_queries(args.qlist), modes, args.repeat, workdir)
+        if args.output is None:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.output, 'w') as fh:
+                json.dump(results, fh, indent=2)
+    else:
+        searcher = load_index(args.index)
+        if args.bench == 'and':
+            bench_and(searcher, args.field, [tuple(p.split(':', 1)) for p in args.pairs])
+        elif args.bench == 'wildcard':
+            bench_wildcard(searcher, args.queries)
@@ -1,9 +1,12 @@
 import argparse
-import pickle
+import os
 import sys
 import time
 
 from SAR_lib import SAR_Project
+from SAR_profile import Profiler
+from SAR_segments import SegmentedIndex
+from SAR_storage import FORMATS, load_index, save_index
 
 
 if __name__ == "__main__":
@@ -18,6 +21,9 @@ if __name__ == "__main__":
     parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False, 
                     help='compute stem index.')
 
+    parser.add_argument('--stem-postings', dest='stem_postings', action='store_true', default=False,
+                    help='with -S, also store the merged posting list of each stem.')
+
     parser.add_argument('-P', '--permuterm', dest='permuterm', action='store_true', default=False,
                     help='compute permuterm index.')
 
@@ -27,19 +33,62 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of worker processes used for indexing.')
+
+    parser.add_argument('-F', '--format', dest='format', choices=FORMATS, default='mmap',
+                    help='format of the saved index: memory-mapped binary index (default) or legacy pickle.')
+
+    parser.add_argument('--no-docstore', dest='nodocstore', action='store_true', default=False,
+                    help='do not save the news in a document store next to the index (index + ".docs").')
+
+    parser.add_argument('-U', '--update', dest='update', action='store_true', default=False,
+                    help='add to an existing index only the news files it does not contain yet. '
+                         'The options of the existing index are kept.')
+
+    parser.add_argument('-G', '--segments', dest='segments', action='store_true', default=False,
+                    help='"index" is a directory with a segmented index: the news files it does not contain yet '
+                         'are indexed in a new segment, and small segments are merged. Only one indexer process '
+                         'may write to a segmented index at a time.')
+
+    parser.add_argument('--profile', dest='profile', metavar='file', type=str, default=None,
+                    help='measure the time and counters of each stage and save them to "file": as JSON if it ends '
+                         'with .json, otherwise as a cProfile report readable with pstats.')
+
     args = parser.parse_args()
 
     newsdir = args.newsdir
     indexfile = args.index
+    args.docstore = None if args.nodocstore else indexfile + '.docs'
+
+    profiler = None if args.profile is None else Profiler(cprofile=not args.profile.endswith('.json'))
 
-    indexer = SAR_Project()
     t0 = time.time()
-    indexer.index_dir(newsdir, **vars(args))
+    if args.segments:
+        args.docstore = not args.nodocstore
+        indexer = SegmentedIndex(indexfile, **vars(args))
+        indexer.set_profile(profiler)
+        print("New files indexed:", indexer.add_dir(newsdir, args.jobs))
+    elif args.update and os.path.exists(indexfile):
+        indexer = load_index(indexfile)
+        indexer.set_profile(profiler)
+        print("New files indexed:", indexer.update_dir(newsdir, **vars(args)))
+    else:
+        indexer = SAR_Project()
+        indexer.set_profile(profiler)
+        indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
-            pickle.dump(indexer, fh)
+    if args.segments:
+        #Cada segmento se guarda al crearlo, solo queda esperar a que termine la fusion
+        indexer.wait()
+    else:
+        save_index(indexer, indexfile, args.format)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
-    print()
\ No newline at end of file
+    print()
+
+    if profiler is not None:
+        profiler.show()
+        profiler.dump(args.profile)
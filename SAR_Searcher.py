@@ -2,10 +2,11 @@
 
 
 import argparse
-import pickle
 import sys
 
 from SAR_lib import SAR_Project
+from SAR_profile import Profiler
+from SAR_segments import open_index
 
 
 def syntax():
@@ -41,6 +42,18 @@ if __name__ == "__main__":
                     help='rank results. Does not apply with -C and -T options.')
 
 
+    parser.add_argument('--cache', dest='cache', type=int, default=SAR_Project.QUERY_CACHE,
+                    help='max number of query sub-expressions whose results are cached, 0 disables the cache.')
+
+    parser.add_argument('--cache-stats', dest='cache_stats', action='store_true', default=False,
+                    help='show the hits and misses of the query cache at the end. Sub-expressions are counted, '
+                         'except for -T and -L -C with -j or a segmented index, where whole queries are counted.')
+
+
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of worker processes used to solve the queries of -L (with -C) and -T.')
+
+
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar= 'query', type=str, action='store',
                     help='query.')
@@ -49,15 +62,22 @@ if __name__ == "__main__":
     group1.add_argument('-T', '--test', dest='test', metavar= 'test', type=str, action='store',
                     help='file with queries and results, for testing.')
 
+    parser.add_argument('--profile', dest='profile', metavar='file', type=str, default=None,
+                    help='measure the time and counters of each stage and save them to "file": as JSON if it ends '
+                         'with .json, otherwise as a cProfile report readable with pstats.')
+
     args = parser.parse_args()
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    # un directorio es un indice por segmentos, si no detecta si esta en el formato binario o en el pickle antiguo
+    searcher = open_index(args.index)
 
     searcher.set_stemming(args.stem)
     searcher.set_ranking(args.rank)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_query_cache(args.cache)
+    profiler = None if args.profile is None else Profiler(cprofile=not args.profile.endswith('.json'))
+    searcher.set_profile(profiler)
 
     # se debe contar o mostrar resultados?
     if args.count is True:
@@ -70,11 +90,15 @@ if __name__ == "__main__":
 
         with open(args.test, encoding='utf-8') as fh:
             lines = fh.read().split('\n')
+            # todas las queries se resuelven de una vez, compartiendo las posting lists de los terminos
+            tests = [line.split('\t') for line in lines if len(line) > 0 and not line.startswith('#')]
+            results = iter(searcher.solve_batch([query for query, reference in tests], args.jobs))
             for line in lines:
                 if len(line) > 0 and not line.startswith('#'):
                     query, reference = line.split('\t')
                     reference = int(reference)
-                    result = searcher.solve_and_count(query)
+                    result = len(next(results))
+                    print("%s\t%d" % (query, result))
                     if result != reference:
                         print("==> ERROR: '%s'\t%d\t%d" % (query, result, reference))
                         sys.exit(-1)
@@ -91,9 +115,15 @@ if __name__ == "__main__":
         with open(args.qlist, encoding='utf-8') as fh:
             queries = fh.read().split('\n')
             queries.pop()
+            if args.count:
+                results = iter(searcher.solve_batch([q for q in queries if len(q) > 0 and not q.startswith('#')],
+                                                    args.jobs))
             for query in queries:
                 if len(query) > 0 and not query.startswith('#'):
-                    fnc(query)
+                    if args.count:
+                        print("%s\t%d" % (query, len(next(results))))
+                    else:
+                        fnc(query)
                 else:
                     print(query)
     else:
@@ -102,3 +132,11 @@ if __name__ == "__main__":
         while query != "":
             fnc(query)
             query = input("query:")
+
+    if args.cache_stats and searcher.query_cache is not None:
+        cache = searcher.query_cache
+        print("Query cache: %d entries, %d hits, %d misses" % (len(cache), cache.hits, cache.misses))
+
+    if profiler is not None:
+        profiler.show()
+        profiler.dump(args.profile)
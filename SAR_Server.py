@@ -0,0 +1,160 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from urllib.parse import parse_qs, urlparse
+
+from SAR_lib import SAR_Project
+from SAR_segments import open_index
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """
+    Atiende las peticiones HTTP del servidor de busqueda, todas con GET y respuesta en JSON:
+        /search?q=query   noticias recuperadas, con las mismas opciones que SAR_Searcher (-A, -R, -N, -S)
+        /count?q=query    nº de noticias recuperadas
+        /doc/<newid>      todos los campos de una noticia
+
+    ThreadingHTTPServer atiende cada peticion en su propio hilo, asi una query lenta no bloquea
+    a los demas clientes. El indice (self.server.searcher) se comparte entre todos los hilos.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        query = params.get('q', [''])[0]
+        searcher = self.server.searcher
+        if url.path == '/search' and query:
+            self.send_json(200, self.search(searcher, query))
+        elif url.path == '/count' and query:
+            self.send_json(200, {'query': query, 'count': len(searcher.solve_query(query))})
+        elif url.path in ('/search', '/count'):
+            self.send_json(400, {'error': "missing query parameter 'q'"})
+        elif url.path.startswith('/doc/'):
+            new = self.get_doc(searcher, url.path[len('/doc/'):])
+            if new is None:
+                self.send_json(404, {'error': 'unknown newid'})
+            else:
+                self.send_json(200, new)
+        else:
+            self.send_json(404, {'error': 'unknown path'})
+
+
+    def search(self, searcher, query):
+        """
+        Resuelve una query y devuelve lo mismo que muestra SAR_Project.solve_and_show.
+        return:
+            -diccionario con la query, el nº de resultados y la lista de noticias mostradas
+        """
+        result = searcher.solve_query(query)
+        shown = searcher.shown_results(result, query)
+        results = []
+        for (newid, score), new in zip(shown, searcher.get_news([newid for newid, score in shown])):
+            item = {'newid': newid, 'score': score, 'date': new['date'],
+                    'title': new['title'], 'keywords': new['keywords']}
+            if searcher.show_snippet:
+                item['snippet'] = searcher.get_snippet(new, query, newid)
+            results.append(item)
+        return {'query': query, 'count': len(result), 'results': results}
+
+
+    def get_doc(self, searcher, newid):
+        """
+        Devuelve una noticia a partir de su newid en texto, None si no existe.
+        """
+        if not newid.isdigit() or int(newid) < 1:
+            return None
+        try:
+            return searcher.get_new(int(newid))
+        except (KeyError, IndexError):
+            return None
+
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class SearchServer(ThreadingHTTPServer):
+    """
+    Servidor HTTP que atiende cada peticion en un hilo, con el indice compartido en self.searcher.
+    """
+
+    daemon_threads = True
+    # cola de conexiones pendientes, con la de por defecto (5) los clientes concurrentes esperan reintentos
+    request_queue_size = 128
+
+    def __init__(self, address, searcher, quiet=False):
+        super().__init__(address, SearchHandler)
+        self.searcher = searcher
+        self.quiet = quiet
+
+
+def serve(searcher, host='127.0.0.1', port=8080, quiet=False):
+    """
+    Sirve las busquedas sobre un indice ya cargado hasta que se interrumpe el proceso.
+    param:
+        -searcher: SAR_Project (o SegmentedIndex) con las opciones de busqueda ya puestas
+        -host, port: direccion en la que se escucha
+        -quiet: si es True no se muestra cada peticion
+    """
+    server = SearchServer((host, port), searcher, quiet)
+    print("Serving on http://%s:%d/" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve the index over HTTP with a JSON API.')
+
+    parser.add_argument('index', metavar='index', type=str,
+                        help='name of the file (or directory, for a segmented index) with the index object.')
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                    help='address to listen on.')
+
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8080,
+                    help='port to listen on.')
+
+    parser.add_argument('-S', '--stem', dest='stem', action='store_true', default=False,
+                    help='use stem index by default.')
+
+    parser.add_argument('-N', '--snippet', dest='snippet', action='store_true', default=False,
+                    help='return a snippet of the retrieved documents.')
+
+    parser.add_argument('-A', '--all', dest='all', action='store_true', default=False,
+                    help='return all the results. If not used, only the first 10 results are returned.')
+
+    parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False,
+                    help='rank results.')
+
+    parser.add_argument('--cache', dest='cache', type=int, default=SAR_Project.QUERY_CACHE,
+                    help='max number of query sub-expressions whose results are cached, 0 disables the cache.')
+
+    parser.add_argument('-q', '--quiet', dest='quiet', action='store_true', default=False,
+                    help='do not log every request.')
+
+    args = parser.parse_args()
+
+    searcher = open_index(args.index)
+
+    searcher.set_stemming(args.stem)
+    searcher.set_ranking(args.rank)
+    searcher.set_showall(args.all)
+    searcher.set_snippet(args.snippet)
+    searcher.set_query_cache(args.cache)
+
+    serve(searcher, args.host, args.port, args.quiet)
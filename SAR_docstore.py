@@ -0,0 +1,89 @@
+from functools import lru_cache
+import json
+import threading
+
+
+class DocStoreWriter:
+    """
+    Escribe el almacen de noticias: un fichero con los campos de cada noticia en JSON,
+    una detras de otra en orden de newid, para poder recuperarlas sin volver a leer los ficheros de los dias.
+    """
+
+    def __init__(self, filename, offsets):
+        """
+        param:
+            -filename: fichero del almacen, se añade al final si ya existe
+            -offsets: array('Q') con la posicion en la que empieza cada noticia, offsets[newid - 1],
+                      y al final el tamaño del fichero. Se actualiza al añadir noticias
+        """
+        self.fh = open(filename, 'ab')
+        self.offsets = offsets
+
+
+    def add(self, record):
+        """
+        Añade una noticia al final del almacen.
+        param:
+            -record: diccionario con los campos de la noticia
+        """
+        data = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+        self.fh.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+
+    def add_store(self, filename, offsets):
+        """
+        Añade al final todas las noticias de otro almacen, por ejemplo el de un indice parcial.
+        param:
+            -filename: fichero del otro almacen
+            -offsets: array con las posiciones de sus noticias
+        """
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        base = self.offsets[-1]
+        self.fh.write(data)
+        self.offsets.extend([base + off for off in offsets[1:]])
+
+
+    def close(self):
+        self.fh.close()
+
+
+class DocStore:
+    """
+    Lee noticias del almacen creado con DocStoreWriter en O(1) a partir de su newid.
+    Las ultimas noticias leidas se guardan en una cache LRU.
+    """
+
+    def __init__(self, filename, offsets, cache_size=256):
+        """
+        param:
+            -filename: fichero del almacen
+            -offsets: array con las posiciones de las noticias
+            -cache_size: nº maximo de noticias en la cache
+        """
+        self.fh = open(filename, 'rb')
+        self.offsets = offsets
+        #El fichero se comparte entre hilos, seek y read deben ir juntos
+        self.lock = threading.Lock()
+        self.get = lru_cache(maxsize=cache_size)(self.read)
+
+
+    def read(self, newid):
+        """
+        Lee una noticia del fichero, sin pasar por la cache.
+        param:
+            -newid: identificador de la noticia
+        return:
+            -diccionario con los campos de la noticia
+        """
+        start = self.offsets[newid - 1]
+        end = self.offsets[newid]
+        with self.lock:
+            self.fh.seek(start)
+            data = self.fh.read(end - start)
+        return json.loads(data)
+
+
+    def close(self):
+        self.fh.close()
@@ -0,0 +1,249 @@
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    #Solo hace falta para leer los ficheros .zst
+    zstandard = None
+
+
+# formatos de los ficheros de noticias: array JSON con todas las noticias del dia o JSON Lines (una por linea)
+NEWS_FORMATS = ('.json', '.jsonl')
+
+# extensiones de los ficheros comprimidos, detras de la del formato (2015-01-01.json.gz)
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+# extensiones de todos los ficheros de noticias que se indexan
+NEWS_SUFFIXES = tuple(fmt + comp for fmt in NEWS_FORMATS for comp in ('',) + COMPRESSED_SUFFIXES)
+
+# tamaño de los bloques que se leen de los ficheros de noticias
+CHUNK_SIZE = 1 << 16
+
+# nº de bloques descomprimidos que el hilo de descompresion puede tener preparados
+PREFETCH = 8
+
+
+def is_compressed(filename):
+    """
+    Indica si un fichero de noticias esta comprimido (.gz o .zst).
+    """
+    return filename.endswith(COMPRESSED_SUFFIXES)
+
+
+def news_format(filename):
+    """
+    Devuelve el formato de un fichero de noticias, '.json' o '.jsonl', sin tener en cuenta la compresion.
+    """
+    if is_compressed(filename):
+        filename = os.path.splitext(filename)[0]
+    return os.path.splitext(filename)[1]
+
+
+def open_news(filename):
+    """
+    Abre un fichero de noticias como texto. Los comprimidos se descomprimen en otro hilo (PrefetchReader),
+    asi la descompresion se solapa con la tokenizacion de las noticias que ya se han leido.
+    param:
+        -filename: fichero de noticias, comprimido o no
+    return:
+        -fichero de texto abierto
+    """
+    if filename.endswith('.gz'):
+        raw = gzip.open(filename, 'rb')
+    elif filename.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("the zstandard package is needed to read '%s'" % filename)
+        raw = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True)
+    else:
+        return open(filename, encoding='utf-8')
+    return io.TextIOWrapper(io.BufferedReader(PrefetchReader(raw), CHUNK_SIZE), encoding='utf-8')
+
+
+def iter_news(filename):
+    """
+    Devuelve las noticias de un fichero de una en una, en el orden del fichero, sin cargarlo entero.
+    param:
+        -filename: fichero con un array JSON de noticias o, si termina en .jsonl, con una noticia por linea.
+                   Cualquiera de los dos puede estar comprimido con gzip (.gz) o zstandard (.zst)
+    return:
+        -generador de diccionarios, uno por noticia
+    """
+    with open_news(filename) as fh:
+        if news_format(filename) == '.jsonl':
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(fh)
+
+
+def read_news(filename, positions):
+    """
+    Lee varias noticias de un fichero en una sola pasada. Se deja de leer (y de descomprimir) al llegar
+    a la ultima, sin procesar el resto del fichero.
+    param:
+        -filename: fichero de noticias
+        -positions: posiciones de las noticias en el fichero, empezando en 0
+    return:
+        -diccionario posicion --> diccionario con los campos de la noticia
+    """
+    wanted = set(positions)
+    last = max(wanted)
+    found = {}
+    news = iter_news(filename)
+    try:
+        for pos, new in enumerate(news):
+            if pos in wanted:
+                found[pos] = new
+            if pos == last:
+                break
+    finally:
+        #Cierra el fichero y para el hilo de descompresion
+        news.close()
+    if len(found) != len(wanted):
+        raise IndexError("news %d not found in '%s'" % (last, filename))
+    return found
+
+
+class PrefetchReader(io.RawIOBase):
+    """
+    Fichero binario de solo lectura que descomprime otro fichero en un hilo aparte, con hasta PREFETCH
+    bloques preparados. zlib y zstandard liberan el GIL al descomprimir, asi que la descompresion
+    avanza mientras el hilo principal decodifica y tokeniza las noticias.
+    """
+
+    def __init__(self, raw, chunk_size=CHUNK_SIZE, depth=PREFETCH):
+        """
+        param:
+            -raw: fichero binario del que se leen los datos ya descomprimidos, se cierra al terminar
+            -chunk_size: nº de bytes que se leen cada vez
+            -depth: nº maximo de bloques leidos que aun no se han consumido
+        """
+        super().__init__()
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.blocks = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.pending = memoryview(b'')
+        self.eof = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        #Hilo de descompresion: un bloque vacio marca el final, un error se pasa al lector
+        try:
+            while True:
+                data = self.raw.read(self.chunk_size)
+                if not self.put(data) or not data:
+                    break
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.raw.close()
+
+
+    def put(self, item):
+        #Espera a que haya sitio en la cola, salvo si el lector ya ha cerrado el fichero
+        while not self.stop.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    def readable(self):
+        return True
+
+
+    def readinto(self, b):
+        if not self.pending and not self.eof:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            self.eof = not block
+            self.pending = memoryview(block)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            self.thread.join()
+        super().close()
+
+
+def iter_json_array(fh, chunk_size=CHUNK_SIZE):
+    """
+    Parser incremental de un array JSON: lee el fichero por bloques y devuelve cada elemento del array
+    en cuanto esta completo, asi solo hay en memoria el bloque actual y el elemento que se esta leyendo.
+    param:
+        -fh: fichero de texto abierto
+        -chunk_size: nº de caracteres que se leen cada vez
+    return:
+        -generador con los elementos del array
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        #Lee otro bloque, descartando lo que ya se ha procesado. Si hay un elemento a medias se lee
+        #al menos lo que ya ocupa, asi un elemento muy grande no se decodifica muchas veces
+        nonlocal buf, pos, eof
+        data = fh.read(max(chunk_size, len(buf) - pos))
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+        return not eof
+
+    def skip(chars):
+        #Avanza sobre los caracteres de "chars" y devuelve el siguiente, '' al final del fichero
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or not fill():
+                return buf[pos:pos + 1]
+
+    if skip(' \t\r\n') != '[':
+        raise ValueError("expected a JSON array in '%s'" % getattr(fh, 'name', fh))
+    pos += 1
+    while True:
+        c = skip(' \t\r\n,')
+        if c == ']':
+            return
+        if c == '':
+            raise ValueError("unterminated JSON array in '%s'" % getattr(fh, 'name', fh))
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                #El elemento no esta completo en el buffer, leemos mas. Si ya no hay mas, el error es real
+                if not fill():
+                    raise
+                continue
+            #Detras del elemento tiene que venir ',' o ']'. Si no se ha leido aun, o viene otra cosa porque
+            #el elemento estaba cortado (un numero como "2." de "2.5"), leemos mas y lo volvemos a decodificar
+            after = end
+            while after < len(buf) and buf[after] in ' \t\r\n':
+                after += 1
+            if after == len(buf) or buf[after] not in ',]':
+                if fill():
+                    continue
+                if after < len(buf):
+                    raise ValueError("expected ',' or ']' after an element of '%s'" % getattr(fh, 'name', fh))
+            pos = end
+            yield item
+            break
@@ -1,7 +1,320 @@
-import json
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+import heapq
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from nltk.stem.snowball import SnowballStemmer
 import os
 import re
+import sys
+import threading
+
+from SAR_docstore import DocStore, DocStoreWriter
+from SAR_input import NEWS_SUFFIXES, iter_news, read_news
+import SAR_profile
+
+
+# tipo de las posting lists: array de enteros sin signo, mucho mas compacto que una lista de int
+POSTING_TYPE = 'I'
+
+
+def pack_postings(terms):
+    """
+    Empaqueta las posting lists de un campo en un unico bloque contiguo para serializarlo con pickle.
+    Se usa el tipo de array mas estrecho en el que quepan los newIDs.
+    param:
+        -terms: diccionario termino --> posting list (array) de un campo
+    return:
+        -tupla (terminos, tipo, longitudes, datos) con las longitudes y los datos en bytes
+    """
+    keys = list(terms)
+    lens = array('I', [len(terms[t]) for t in keys])
+    data = array(POSTING_TYPE)
+    for t in keys:
+        data.extend(terms[t])
+    #Si todos los newIDs caben en 16 bits, guardamos la mitad de bytes
+    if len(data) == 0 or max(data) < 1 << 16:
+        data = array('H', data)
+    return keys, data.typecode, lens.tobytes(), data.tobytes()
+
+
+def unpack_postings(packed):
+    """
+    Inversa de pack_postings.
+    param:
+        -packed: tupla devuelta por pack_postings
+    return:
+        -diccionario termino --> posting list (array)
+    """
+    keys, typecode, lens, data = packed
+    lens = array('I', lens)
+    raw = array(typecode)
+    raw.frombytes(data)
+    if typecode != POSTING_TYPE:
+        raw = array(POSTING_TYPE, raw)
+    terms = {}
+    pos = 0
+    for t, n in zip(keys, lens):
+        terms[t] = raw[pos:pos + n]
+        pos += n
+    return terms
+
+
+# posiciones de los bits a 1 de cada valor de un byte, para decodificar los mapas de bits
+BYTE_BITS = [tuple(i for i in range(8) if b >> i & 1) for b in range(256)]
+
+
+class Bitmap:
+    """
+    Posting list representada como mapa de bits: el bit i esta a 1 si la noticia con newid i esta en la lista.
+    Se guarda en un entero de Python, asi AND, OR y NOT entre mapas de bits son operaciones bit a bit
+    que se hacen en C sobre palabras enteras.
+
+    Se comporta como una posting list de solo lectura: admite len, iteracion e indexacion
+    (la lista de newids se construye solo si hace falta).
+    """
+
+    __slots__ = ('bits', 'count', 'data', 'plist')
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.count = None # nº de bits a 1, se calcula al pedirlo
+        self.data = None # bits en bytes (little endian) para consultar un newid en O(1)
+        self.plist = None # lista de newids
+
+
+    @classmethod
+    def from_posting(cls, p):
+        """
+        Construye el mapa de bits de una posting list ordenada.
+        """
+        if isinstance(p, Bitmap):
+            return p
+        data = bytearray((p[-1] >> 3) + 1 if len(p) else 0)
+        for x in p:
+            data[x >> 3] |= 1 << (x & 7)
+        return cls(int.from_bytes(data, 'little'))
+
+
+    def __reduce__(self):
+        return (Bitmap, (self.bits,))
+
+
+    def __len__(self):
+        if self.count is None:
+            self.count = self.bits.bit_count()
+        return self.count
+
+
+    def __contains__(self, x):
+        if self.data is None:
+            self.data = self.bits.to_bytes((self.bits.bit_length() + 7) >> 3, 'little')
+        i = x >> 3
+        return i < len(self.data) and self.data[i] >> (x & 7) & 1 == 1
+
+
+    def to_posting(self):
+        """
+        Devuelve la posting list (array ordenado de newids) del mapa de bits.
+        """
+        if self.plist is None:
+            plist = array(POSTING_TYPE)
+            data = self.bits.to_bytes((self.bits.bit_length() + 7) >> 3, 'little')
+            for i, byte in enumerate(data):
+                if byte:
+                    base = i << 3
+                    plist.extend([base + b for b in BYTE_BITS[byte]])
+            self.plist = plist
+        return self.plist
+
+
+    def __iter__(self):
+        return iter(self.to_posting())
+
+
+    def __getitem__(self, i):
+        return self.to_posting()[i]
+
+
+def encode_positions(positions, out):
+    """
+    Añade a "out" las posiciones de un termino en una noticia codificadas como
+    diferencias con la anterior en varint (7 bits por byte, el bit alto indica que sigue otro byte).
+    param:
+        -positions: lista ordenada de posiciones
+        -out: bytearray en el que se escribe
+    """
+    prev = 0
+    for pos in positions:
+        delta = pos - prev
+        prev = pos
+        while delta >= 0x80:
+            out.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        out.append(delta)
+
+
+def decode_positions(data, start, end):
+    """
+    Inversa de encode_positions.
+    param:
+        -data: bytes con las posiciones codificadas
+        -start, end: tramo de "data" con las posiciones de una noticia
+    return:
+        -lista ordenada de posiciones
+    """
+    positions = []
+    pos = 0
+    delta = 0
+    shift = 0
+    for i in range(start, end):
+        byte = data[i]
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            pos += delta
+            positions.append(pos)
+            delta = 0
+            shift = 0
+    return positions
+
+
+class QueryCache:
+    """
+    Cache LRU con los resultados de las subexpresiones de las queries: clave nodo optimizado del arbol
+    (ver SAR_Project.optimize_query), valor su posting list. Se usa como "memo" de SAR_Project.eval_query,
+    asi las subconsultas repetidas entre queries distintas tampoco se vuelven a evaluar.
+
+    Los resultados dependen del modo de la busqueda (version del indice y stemming), al cambiar
+    el modo se vacia la cache.
+    """
+
+    def __init__(self, maxsize):
+        """
+        param:
+            -maxsize: nº maximo de subexpresiones guardadas
+        """
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.mode = None
+        self.hits = 0 # nº de subexpresiones encontradas en la cache
+        self.misses = 0 # nº de subexpresiones que no estaban y se han evaluado
+        #La cache se puede compartir entre hilos
+        self.lock = threading.Lock()
+
+
+    def set_mode(self, mode):
+        """
+        Cambia el modo de la busqueda, si es distinto del actual se descartan todos los resultados.
+        param:
+            -mode: tupla con lo que cambia el resultado de una query ademas de la propia query
+        """
+        with self.lock:
+            if mode != self.mode:
+                self.entries.clear()
+                self.mode = mode
+
+
+    def __contains__(self, node):
+        return node in self.entries
+
+
+    def get(self, node):
+        """
+        Devuelve el resultado de una subexpresion y la marca como la usada mas recientemente.
+        return:
+            -posting list, None si no esta en la cache
+        """
+        with self.lock:
+            res = self.entries.get(node)
+            if res is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(node)
+            return res
+
+
+    def __setitem__(self, node, res):
+        with self.lock:
+            self.entries[node] = res
+            self.entries.move_to_end(node)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class BatchMemo(dict):
+    """
+    Memo de SAR_Project.solve_batch: guarda todas las subexpresiones del lote, para que la posting list
+    de cada termino se recupere una sola vez aunque el lote tenga mas que la cache, y ademas las busca
+    y las guarda en la QueryCache (o en el diccionario vacio si esta desactivada), como self.solve_query.
+    """
+
+    def __init__(self, cache):
+        super().__init__()
+        self.cache = cache
+
+
+    def get(self, node):
+        res = self.cache.get(node)
+        if res is None:
+            res = super().get(node)
+        return res
+
+
+    def __setitem__(self, node, res):
+        super().__setitem__(node, res)
+        self.cache[node] = res
+
+
+def index_chunk(filenames, multifield, positional=False, docstore=None):
+    """
+    Indexa un grupo de ficheros en un proceso independiente, para la indexacion en paralelo.
+    param:
+        -filenames: lista con las rutas de los ficheros a indexar, en el orden del recorrido secuencial
+        -multifield: si se deben indexar todos los campos
+        -positional: si se deben guardar las posiciones de los terminos
+        -docstore: fichero en el que guardar el almacen de noticias parcial, None para no guardarlo
+    return:
+        -SAR_Project con el indice parcial, con docIDs y newIDs locales que empiezan en 1
+    """
+    part = SAR_Project()
+    part.multifield = multifield
+    part.positional = positional
+    if docstore is not None:
+        part.open_docstore(docstore)
+    for filename in filenames:
+        part.index_file(filename)
+    part.close_docstore()
+    return part
+
+
+# indice de cada proceso de SAR_Project.solve_batch_parallel
+batch_project = None
+
+
+def init_batch(project):
+    """
+    Inicializa un proceso de SAR_Project.solve_batch_parallel con el indice en el que se busca.
+    """
+    global batch_project
+    batch_project = project
+
+
+def solve_batch_chunk(queries):
+    """
+    Resuelve un grupo de queries en un proceso de SAR_Project.solve_batch_parallel.
+    Las posting lists leidas del indice proyectado en memoria (memoryview) se copian para poder devolverlas.
+    """
+    return [p if isinstance(p, (array, Bitmap)) else array(POSTING_TYPE, p) for p in batch_project.solve_batch(queries)]
 
 
 class SAR_Project:
@@ -23,9 +336,50 @@ class SAR_Project:
               ("summary", True)]
     
     
+    # campo de las queries que busca en todos los campos a la vez ("any:termino")
+    ANY_FIELD = 'any'
+
+    # peso de cada campo en el ranking de los terminos de "any:", el resto de campos pesan 1
+    FIELD_BOOST = {'title': 2.0, 'keywords': 1.5, 'summary': 1.2, 'date': 0.0}
+
+    # expresion regular de los tokens del texto: las secuencias de caracteres alfanumericos, es decir
+    # lo que queda al separar por self.tokenizer. findall los saca sin crear la cadena intermedia
+    token_pattern = re.compile(r'\w+')
+
+    # expresion regular para separar los tokens de las queries: parentesis, frases entre comillas, rangos y terminos
+    query_tokenizer = re.compile(r'\(|\)|[^\s()"]*"[^"]*"?|[^\s()\[]*\[[^\]]*\]|[^\s()]+')
+
+    # rango de valores de un campo en una query: campo:[desde TO hasta]
+    query_range = re.compile(r'(?:([^\s:\[]*):)?\[\s*(\S+)\s+TO\s+(\S+?)\s*\]')
+
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
+    # a partir de esta proporcion entre las longitudes de dos posting lists el AND usa galloping
+    GALLOP_RATIO = 3
+
+    # los terminos que aparecen en al menos 1 de cada BITMAP_RATIO noticias se guardan tambien como mapa de bits
+    BITMAP_RATIO = 32
+
+    # los fragmentos del snippet tienen los terminos de la query a menos de SNIPPET_WINDOW tokens,
+    # SNIPPET_CONTEXT tokens mas por cada lado, y hay como mucho SNIPPET_FRAGMENTS fragmentos
+    SNIPPET_WINDOW = 20
+    SNIPPET_CONTEXT = 5
+    SNIPPET_FRAGMENTS = 3
+
+    # nº maximo de noticias que se guardan ya leidas en memoria para mostrar resultados
+    DOC_CACHE = 256
+
+    # nº maximo de stems de terminos que no estan en el vocabulario del indice que se guardan en memoria
+    STEM_CACHE = 4096
+
+    # nº maximo de subexpresiones de queries cuyo resultado se guarda, se cambia con self.set_query_cache()
+    QUERY_CACHE = 1024
+
+    # parametros de BM25 para el ranking de resultados
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
  
     def __init__(self):
         """
@@ -40,17 +394,93 @@ class SAR_Project:
                         # Si se hace la implementacion multifield, se pude hacer un segundo nivel de hashing de tal forma que:
                         # self.index['title'] seria el indice invertido del campo 'title'.
         self.sindex = {} # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
-        self.ptindex = {} # hash para el indice permuterm.
+        self.stems = {} # hash con el stem de cada termino del vocabulario de todos los campos --> clave: termino, valor: stem
+        self.spindex = {} # hash opcional con la posting list de cada stem ya fusionada --> clave: campo y stem, valor: posting list
+        self.ptindex = {} # hash para el indice permuterm --> clave: campo, valor: lista ordenada con todas las rotaciones
+                          # de los terminos del campo terminados en '$'. El termino se recupera de la propia rotacion
+        self.bindex = {} # hash con los mapas de bits (Bitmap) de los terminos muy frecuentes, por campo
+        self.rindex = {} # hash para las queries de rangos en los campos sin tokenizar (date) --> clave: campo,
+                         # valor: (lista ordenada de los valores del campo, lista con los tramos consecutivos de newids
+                         # (primero, ultimo) de cada valor)
+        self.pindex = {} # hash para el indice posicional --> clave: campo y termino, valor: (offsets, posiciones).
+                         # "posiciones" es un bytearray con las posiciones de cada noticia de la posting list codificadas
+                         # con encode_positions, "offsets" un array con donde empiezan las de cada noticia
         self.docs = {} # diccionario de documentos --> clave: entero(docid),  valor: ruta del fichero.
-        self.weight = {} # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
+        self.weight = {} # hash de terminos para el pesado, ranking de resultados --> clave: campo y termino,
+                         # valor: array con la frecuencia del termino en cada noticia de su posting list
+        self.doclen = {} # hash con la longitud (nº de terminos) de cada noticia --> clave: campo, valor: array indexado por newid
         self.news = {} # hash de noticias --> clave entero (newid), valor: la info necesaria para diferenciar la noticia dentro de su fichero (doc_id y posición dentro del documento)
         #Integer : (doc_id,pos) 
+        self.docstore = None # fichero del almacen de noticias, con los campos de cada noticia para mostrar resultados
+        self.doc_offsets = array('Q', [0]) # posicion de cada noticia en el almacen, la noticia newid va de doc_offsets[newid - 1] a doc_offsets[newid]
+        self.docwriter = None # DocStoreWriter abierto mientras se indexa
+        self.docreader = None # DocStore para leer noticias, se abre al pedir la primera
+        self.newcache = None # QueryCache (filename, posicion) --> noticia de los ficheros de los dias, si no hay almacen
+        self.stemcache = None # stemmer con cache LRU para los terminos que no estan en self.stems
+        self.version = 0 # version del indice, cambia cada vez que se modifica e invalida la cache de queries
+        self.query_cache = None # QueryCache con los resultados de las subconsultas, se crea con la primera query
         self.tokenizer = re.compile("\W+") # expresion regular para hacer la tokenizacion
         self.stemmer = SnowballStemmer('spanish') # stemmer en castellano
         self.show_all = False # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.query_cache_size = self.QUERY_CACHE # valor por defecto, se cambia con self.set_query_cache()
+        self.profiler = None # Profiler con los tiempos de cada etapa, se cambia con self.set_profile()
+
+
+    def __getstate__(self):
+        """
+        Estado que se guarda con pickle: las posting lists y las frecuencias de cada campo
+        se empaquetan en un unico bloque de bytes (ver pack_postings).
+        """
+        state = self.__dict__.copy()
+        state['index'] = {field: pack_postings(terms) for field, terms in self.index.items()}
+        state['weight'] = {field: pack_postings(terms) for field, terms in self.weight.items()}
+        state['spindex'] = {field: pack_postings(stems) for field, stems in self.spindex.items()}
+        #Ficheros abiertos y caches, no se guardan
+        state['docwriter'] = state['docreader'] = state['newcache'] = state['query_cache'] = None
+        state['stemcache'] = None
+        #Metodos envueltos por el profiler
+        for name in SAR_profile.ENTRIES + tuple(SAR_profile.STAGES):
+            state.pop(name, None)
+        state['profiler'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        """
+        Restaura el estado guardado por __getstate__.
+        Los indices antiguos, con posting lists de tipo list, se convierten a array.
+        """
+        index = {}
+        for field, terms in state['index'].items():
+            if isinstance(terms, tuple):
+                index[field] = unpack_postings(terms)
+            else:
+                index[field] = {t: array(POSTING_TYPE, p) for t, p in terms.items()}
+        state['index'] = index
+        state['weight'] = {field: unpack_postings(terms) if isinstance(terms, tuple) else terms
+                           for field, terms in state['weight'].items()}
+        state['spindex'] = {field: unpack_postings(stems) for field, stems in state.get('spindex', {}).items()}
+        #Indices guardados antes de los mapas de bits
+        state.setdefault('bindex', {})
+        state.setdefault('pindex', {})
+        state.setdefault('rindex', {})
+        state.setdefault('doclen', {})
+        state.setdefault('stem_postings', False)
+        #Indices permuterm antiguos: diccionario rotacion --> terminos
+        state['ptindex'] = {field: sorted(permus) if isinstance(permus, dict) else permus
+                            for field, permus in state['ptindex'].items()}
+        state.setdefault('docstore', None)
+        state.setdefault('doc_offsets', array('Q', [0]))
+        state.setdefault('version', 0)
+        state.setdefault('query_cache_size', self.QUERY_CACHE)
+        state.setdefault('profiler', None)
+        state.setdefault('stems', {})
+        state['stemcache'] = None
+        state['docwriter'] = state['docreader'] = state['newcache'] = state['query_cache'] = None
+        self.__dict__.update(state)
 
 
     ###############################
@@ -120,6 +550,57 @@ class SAR_Project:
         self.use_ranking = v
 
 
+    def set_query_cache(self, v):
+        """
+
+        Cambia el tamaño de la cache de resultados de las queries.
+
+        input: "v" entero.
+
+        si "v" es 0 no se guardan resultados entre queries, solo se reutilizan las subexpresiones repetidas
+        dentro de una misma query.
+
+        """
+        self.query_cache_size = v
+        self.query_cache = None
+
+
+    def set_profile(self, profiler):
+        """
+
+        Activa o desactiva la medida de tiempos y contadores de cada etapa de las queries y la indexacion.
+
+        input: "profiler" SAR_profile.Profiler en el que se guardan las medidas, None para desactivarla.
+
+        Los metodos que se miden se sustituyen en la instancia por versiones envueltas por el profiler,
+        al desactivarlo se quitan y la clase queda como estaba, sin ningun coste.
+
+        """
+        for name in SAR_profile.ENTRIES + tuple(SAR_profile.STAGES):
+            self.__dict__.pop(name, None)
+        self.profiler = profiler
+        if profiler is None:
+            return
+        for name in SAR_profile.ENTRIES:
+            setattr(self, name, profiler.entry(name, getattr(self, name)))
+        for name, counter in SAR_profile.STAGES.items():
+            setattr(self, name, profiler.stage(name, getattr(self, name), counter))
+
+
+    def get_query_cache(self):
+        """
+        Devuelve la cache de resultados de las queries para el modo de busqueda actual, creandola si hace falta.
+        return:
+            -QueryCache, o un diccionario vacio si la cache esta desactivada
+        """
+        if self.query_cache_size <= 0:
+            return {}
+        if self.query_cache is None:
+            self.query_cache = QueryCache(self.query_cache_size)
+        self.query_cache.set_mode((self.version, self.use_stemming))
+        return self.query_cache
+
+
 
 
     ###############################
@@ -138,25 +619,200 @@ class SAR_Project:
 
         """
 
+        self.index_list(self.list_files(root), **args)
+
+
+    def index_list(self, filenames, **args):
+        """
+        Indexa una lista de ficheros, es la parte de self.index_dir que no depende de como se obtienen.
+        param:
+            -filenames: lista de ficheros a indexar, en orden
+            -args: las mismas opciones que en self.index_dir
+        """
         self.multifield = args['multifield']
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        self.stem_postings = args.get('stem_postings', False)
 
         self.set_stemming(self.stemming)
-        for dir, subdirs, files in os.walk(root):
-            for filename in files:
-                if filename.endswith('.json'):
-                    fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+        #Almacen de noticias para mostrar los resultados
+        if args.get('docstore'):
+            self.open_docstore(args['docstore'], new=True)
+        self.index_files(filenames, args.get('jobs') or 1)
+        self.make_secondary()
+        self.version += 1
+
+
+    def make_secondary(self):
+        """
+        Crea los indices que se calculan a partir de self.index: stems, permuterm y mapas de bits.
+        """
         #Opción de stemming activada
         if self.use_stemming:
             self.make_stemming()
         #Opción de permuterm activada
         if self.permuterm:
             self.make_permuterm()
+        self.make_bitmaps()
+        self.make_ranges()
+
+
+
+    def list_files(self, root):
+        """
+        Devuelve los ficheros de noticias que hay dentro del directorio "root".
+        Se devuelven ordenados por ruta, asi los docIDs y newIDs son los mismos con y sin paralelismo
+        y, como los ficheros de cada dia se llaman por su fecha, las noticias se numeran en orden de fecha.
+        """
+        return sorted(os.path.join(dir, filename)
+                      for dir, subdirs, files in os.walk(root)
+                      for filename in files if filename.endswith(NEWS_SUFFIXES))
+
+
+    def index_files(self, filenames, jobs=1):
+        """
+        Indexa una lista de ficheros, en orden, y cierra el almacen de noticias al terminar.
+        param:
+            -filenames: lista de ficheros a indexar
+            -jobs: nº de procesos, con 1 se indexa de forma secuencial
+        """
+        if jobs > 1 and len(filenames) > 1:
+            self.index_files_parallel(filenames, jobs)
+        else:
+            for fullname in filenames:
+                self.index_file(fullname)
+        self.close_docstore()
+
+
+    def update_dir(self, root, **args):
+        """
+        Indexacion incremental: añade al indice ya creado los ficheros de "root" que no estan en self.docs,
+        sin volver a indexar los anteriores. Se usan las opciones con las que se creo el indice.
+
+        Las noticias nuevas reciben newIDs mayores que todas las anteriores, asi que basta con añadirlas
+        al final de las posting lists. Los stems y permuterms solo se calculan para los terminos nuevos
+        y los mapas de bits y posting lists de stems solo se rehacen para los terminos con noticias nuevas.
+
+        param:
+            -root: directorio con las noticias
+            -args: solo se usa "jobs", nº de procesos
+        return:
+            -nº de ficheros nuevos indexados
+        """
+        known = {os.path.normpath(filename) for filename in self.docs.values()}
+        filenames = [f for f in self.list_files(root) if os.path.normpath(f) not in known]
+        if not filenames:
+            return 0
+        #Los indices cargados del formato binario son de solo lectura, los pasamos a memoria
+        self.index = {field: terms if isinstance(terms, dict) else {t: array(POSTING_TYPE, p) for t, p in terms.items()}
+                      for field, terms in self.index.items()}
+        self.weight = {field: terms if isinstance(terms, dict) else {t: array('I', tfs) for t, tfs in terms.items()}
+                       for field, terms in self.weight.items()}
+        self.pindex = {field: terms if isinstance(terms, dict) else
+                       {t: (array('I', offsets), bytearray(positions)) for t, (offsets, positions) in terms.items()}
+                       for field, terms in self.pindex.items()}
+        self.ptindex = {field: permus if isinstance(permus, list) else list(permus)
+                        for field, permus in self.ptindex.items()}
+        #Los terminos nuevos se añaden al final de cada diccionario, basta con saber cuantos habia
+        old_terms = {field: len(terms) for field, terms in self.index.items()}
+        old_news = len(self.news)
+        if self.docstore is not None and os.path.exists(self.docstore):
+            self.open_docstore(self.docstore)
+        self.index_files(filenames, args.get('jobs') or 1)
+        new_terms = {field: list(terms)[old_terms.get(field, 0):] for field, terms in self.index.items()}
+        #Terminos que aparecen en alguna noticia nueva
+        touched = {field: [t for t, p in terms.items() if p[-1] > old_news] for field, terms in self.index.items()}
+        if self.stemming:
+            self.process_stemming_multifield(new_terms)
+            if self.spindex:
+                #Sacamos el stem de cada termino de self.sindex, es mas rapido que volver a calcularlo
+                stems = {}
+                for field, terms in touched.items():
+                    terms = set(terms)
+                    stems[field] = [stem for stem, variants in self.sindex.get(field, {}).items()
+                                    if not terms.isdisjoint(variants)]
+                self.make_stem_postings(stems)
+        if self.permuterm:
+            self.make_permuterm(new_terms)
+        self.make_bitmaps(touched)
+        self.make_ranges()
+        self.version += 1
+        return len(filenames)
+
+
+    def index_files_parallel(self, filenames, jobs):
+        """
+        Indexa una lista de ficheros repartiendola en grupos consecutivos entre "jobs" procesos.
+        Cada proceso construye un indice parcial y despues se fusionan en orden con self.merge_index,
+        por lo que el resultado es identico al de la indexacion secuencial.
+        param:
+            -filenames: lista de ficheros a indexar
+            -jobs: nº de procesos
+        """
+        #Hacemos mas grupos que procesos para repartir mejor la carga
+        nchunks = min(len(filenames), jobs * 4)
+        size = -(-len(filenames) // nchunks)
+        chunks = [filenames[i:i + size] for i in range(0, len(filenames), size)]
+        #Cada proceso escribe su propio almacen de noticias, se concatenan al fusionar
+        if self.docwriter is not None:
+            stores = ['%s.part%d' % (self.docstore, i) for i in range(len(chunks))]
+        else:
+            stores = [None] * len(chunks)
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            #map devuelve los resultados en el orden de los grupos
+            for part in executor.map(index_chunk, chunks, [self.multifield] * len(chunks),
+                                     [self.positional] * len(chunks), stores):
+                self.merge_index(part)
+
+
+    def merge_index(self, other):
+        """
+        Añade al final del indice actual el indice de "other", desplazando sus docIDs y newIDs.
+        Como los newIDs de "other" son mayores que todos los actuales, las posting lists siguen ordenadas.
+        param:
+            -other: SAR_Project con un indice parcial
+        """
+        doc_offset = len(self.docs)
+        news_offset = len(self.news)
+        for docID, filename in other.docs.items():
+            self.docs[docID + doc_offset] = filename
+        for newID, (docID, pos) in other.news.items():
+            self.news[newID + news_offset] = (docID + doc_offset, pos)
+        if self.docwriter is not None and other.docstore is not None:
+            self.docwriter.add_store(other.docstore, other.doc_offsets)
+            os.remove(other.docstore)
+        for field, terms in other.index.items():
+            aux = self.index.setdefault(field, {})
+            for term, plist in terms.items():
+                plist = array(POSTING_TYPE, [newID + news_offset for newID in plist])
+                if term in aux:
+                    aux[term].extend(plist)
+                else:
+                    #Los terminos de los indices parciales vienen de pickle, se internan como al indexar
+                    aux[sys.intern(term)] = plist
+        for field, terms in other.weight.items():
+            aux = self.weight.setdefault(field, {})
+            for term, tfs in terms.items():
+                if term in aux:
+                    aux[term].extend(tfs)
+                else:
+                    #Copia, "other" puede seguir en uso (por ejemplo un segmento que se esta consultando)
+                    aux[sys.intern(term)] = array('I', tfs)
+        for field, lens in other.doclen.items():
+            #La posicion 0 no corresponde a ninguna noticia
+            self.doclen.setdefault(field, array('I', [0])).extend(lens[1:])
+        for field, terms in other.pindex.items():
+            aux = self.pindex.setdefault(field, {})
+            for term, (offsets, positions) in terms.items():
+                if term in aux:
+                    #Las posiciones se añaden al final, desplazamos donde empiezan las de cada noticia
+                    old_offsets, old_positions = aux[term]
+                    old_offsets.extend([off + len(old_positions) for off in offsets])
+                    old_positions.extend(positions)
+                else:
+                    aux[sys.intern(term)] = (array('I', offsets), bytearray(positions))
 
-        
 
     def index_file(self, filename):
         """
@@ -169,19 +825,16 @@ class SAR_Project:
         Dependiendo del valor de "self.multifield" y "self.positional" se debe ampliar el indexado.
         En estos casos, se recomienda crear nuevos metodos para hacer mas sencilla la implementacion
 
-        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp).
-                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia
+        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp)
+                o JSON Lines (.jsonl), sin comprimir o comprimido (.gz, .zst). Las noticias se leen de una en una
+                con iter_news, sin cargar el fichero entero, cada una es un diccionario
 
         """
-        with open(filename) as fh:
-            jlist = json.load(fh)
         #
-        # "jlist" es una lista con tantos elementos como noticias hay en el fichero,
-        # cada noticia es un diccionario con los campos:
+        # Cada noticia es un diccionario con los campos:
         #      "title", "date", "keywords", "article", "summary"
         #
         # En la version basica solo se debe indexar el contenido "article"
-        # "jlist" es, en definitiva, una lista con diccionario dentro con los campos enumerados arriba
         #
         #
         #Como identificador secuencial vamos a usar la longitud del diccionario + 1
@@ -189,41 +842,99 @@ class SAR_Project:
         self.docs[len(self.docs) + 1] = filename
         #ID del último docID
         docID = len(self.docs)
-        for i in range(len(jlist)):
+        #Noticia en formato de dict. y su posicion en el fichero
+        for i, new in enumerate(iter_news(filename)):
             #Insertanos la noticia con un clave secuencial que depende de la longitud de la lista 
             # y el valor es una tupla (docID,posición)
             #NOTA: Índice comienza en 1 y no en 0
             self.news[len(self.news) + 1] = (docID,i)
-            #Noticia en formato de dict.
-            new = jlist[i]
+            if self.docwriter is not None:
+                self.docwriter.add({f[0]: new.get(f[0]) for f in self.fields})
             if self.multifield:
                 self.process_field(new,fields=self.fields)
             else:
                 self.process_field(new)
 
 
+    def open_docstore(self, filename, new=False):
+        """
+        Abre el almacen de noticias para ir añadiendo las noticias que se indexan.
+        param:
+            -filename: fichero del almacen
+            -new: si es True se vacia el almacen antes de empezar
+        """
+        if new:
+            open(filename, 'wb').close()
+            self.doc_offsets = array('Q', [0])
+        self.docstore = filename
+        self.docwriter = DocStoreWriter(filename, self.doc_offsets)
+
+
+    def close_docstore(self):
+        """
+        Cierra el almacen de noticias al terminar de indexar.
+        """
+        if self.docwriter is not None:
+            self.docwriter.close()
+            self.docwriter = None
+
+
     def process_field(self,new,fields=[('article',True)]):
         """
-        Dado una noticia, se encarga de añadir los términos a sus correspondientes campos, para la versión multifield
+        Dado una noticia, se encarga de añadir los términos a sus correspondientes campos, para la versión multifield.
+        Tambien guarda la frecuencia de cada termino (self.weight) y la longitud del campo (self.doclen),
+        necesarias para el ranking con BM25.
         param:
         -new:es la noticia en cuestión que pasamos como diccionario
         -fields:campos en los que vamos a escribir, útil para la versión mutifield, valor por defecto ('article',True)
                 para la versión básica del proyecto
         """
+        newid = len(self.news)
         #Recorremos los campos que tienen tuplas (campo, bool)
-        for f in fields:
-            if f[1]: content = self.tokenize(new[f[0]]) #Articulo tokenizado y separado por espacios
-            else: content = [new[f[0]]] #date no se tokeniza
-            for term in content: #recorremos los términos del contenido
-                aux = self.index.get(f[0], {})
-                #Si el término no se encuentra en el diccionario, creamos la posting list para dicho campo
-                if term not in aux:
-                    aux[term] = [len(self.news)]
-                #Si la ultima noticia añadida es diferente a la actual, añadimos
-                elif aux[term][-1] != len(self.news):
-                    aux[term].append(len(self.news))
-                #Actualizamos el indice
-                self.index[f[0]] = aux
+        for field, tokenize in fields:
+            if tokenize: content = self.tokenize(new[field]) #Articulo tokenizado
+            else: content = [new[field]] #date no se tokeniza
+            #Diccionarios del campo, fuera del bucle de terminos
+            index = self.index.setdefault(field, {})
+            weight = self.weight.setdefault(field, {})
+            #Cada termino distinto de la noticia una sola vez, con su frecuencia
+            for term, tf in Counter(content).items():
+                plist = index.get(term)
+                if plist is None:
+                    #Los terminos nuevos se internan, asi el mismo objeto es la clave en todos los indices
+                    term = sys.intern(term)
+                    index[term] = array(POSTING_TYPE, [newid])
+                else:
+                    plist.append(newid)
+                tfs = weight.get(term)
+                if tfs is None:
+                    weight[sys.intern(term)] = array('I', [tf])
+                else:
+                    tfs.append(tf)
+            #La posicion 0 no corresponde a ninguna noticia
+            self.doclen.setdefault(field, array('I', [0])).append(len(content))
+            if self.positional:
+                self.process_positions(field, content)
+
+
+    def process_positions(self, field, content):
+        """
+        Guarda en el indice posicional (self.pindex) las posiciones de los terminos de un campo de la ultima noticia.
+        param:
+            -field: campo de la noticia
+            -content: lista de terminos del campo, en orden
+        """
+        #Posiciones de cada termino en la noticia
+        positions = {}
+        for pos, term in enumerate(content):
+            positions.setdefault(term, []).append(pos)
+        aux = self.pindex.setdefault(field, {})
+        for term, plist in positions.items():
+            if term not in aux:
+                aux[sys.intern(term)] = (array('I'), bytearray())
+            offsets, data = aux[term]
+            offsets.append(len(data))
+            encode_positions(plist, data)
 
     def tokenize(self, text):
         """
@@ -237,7 +948,7 @@ class SAR_Project:
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.token_pattern.findall(text.lower())
 
 
 
@@ -251,51 +962,127 @@ class SAR_Project:
 
         """
         self.process_stemming_multifield()
+        if self.stem_postings:
+            self.make_stem_postings()
+
+
+    def make_stem_postings(self, stems=None):
+        """
+        Crea el indice opcional self.spindex con la posting list de cada stem, fusionando una sola vez
+        al indexar las de todos sus terminos. Asi get_stemming es un unico acceso a un diccionario.
+        param:
+            -stems: diccionario campo --> stems cuya posting list hay que rehacer, por defecto todos
+        """
+        if stems is None:
+            stems = self.sindex
+        for k, aux in stems.items():
+            spindex = self.spindex.setdefault(k, {})
+            for stem in aux:
+                spindex[stem] = self.or_postings([self.index[k][term] for term in self.sindex[k][stem]])
 
 
-    def process_stemming_multifield(self):
+    def process_stemming_multifield(self, new_terms=None):
         """
         Hace stemming en cada término de cada field y lo introduce en self.sindex[field]
+        param:
+            -new_terms: diccionario campo --> lista de terminos que no estan aun en self.sindex,
+                        para la indexacion incremental. Por defecto se rehace con todos los terminos
         """
+        if new_terms is None:
+            self.sindex = {}
+            self.stems = {}
+            new_terms = self.index
+        #Stem de cada termino distinto una sola vez, aunque aparezca en varios campos
+        stems = self.stems
+        for v in new_terms.values():
+            for term in v:
+                if term not in stems:
+                    stems[term] = sys.intern(self.stemmer.stem(term))
         #Obtenemos clave y valor
-        for k,v in self.index.items():
+        for k,v in new_terms.items():
             #Si no se había creado el campo previamente
-            self.sindex[k] = {}
+            aux = self.sindex.setdefault(k, {})
             #Recorremos los valores
             for term in v:
-                #Obtenemos el stem de cada término
-                stem = self.stemmer.stem(term)
-                #Si el stem no se encuentra en la entrada del field, creamos una lista de 1 elemento
-                if stem not in self.sindex[k]:
-                    self.sindex[k][stem] = [term]
-                #Si el término no está en la entrada del field del stem correspondiente
-                elif term not in self.sindex[k][stem]:
-                    self.sindex[k][stem].append(term)
-    
-    def make_permuterm(self):
+                #Los términos del campo no se repiten, no hace falta comprobar si ya está en la lista del stem
+                aux.setdefault(stems[term], []).append(term)
+
+
+    def make_permuterm(self, new_terms=None):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
 
         Crea el indice permuterm (self.ptindex) para los terminos de todos los indices.
 
+        param:
+            -new_terms: diccionario campo --> lista de terminos que no estan aun en self.ptindex,
+                        para la indexacion incremental. Por defecto se rehace con todos los terminos
+
         """
-        for k,v in self.index.items():
-            #Recorremos los valores
-            self.ptindex[k] = {}
+        if new_terms is None:
+            self.ptindex = {}
+            new_terms = self.index
+        for k,v in new_terms.items():
+            #Las rotaciones nuevas se añaden a las que ya habia
+            permus = self.ptindex.get(k, [])
             #Añadimos símbolo del dolar
             for term in v:
                 aux = term + '$'
                 #Obtenemos todas las rotaciones del término
                 for i in range(len(aux)):
-                    #Obtenemos la permutación
-                    permu = aux[i:] + aux[:i]
-                    #Comprobamos si la permutación está en el diccionario
-                    if permu not in self.ptindex[k]:
-                        #No está, lista
-                        self.ptindex[k][permu] = [term]
+                    permus.append(aux[i:] + aux[:i])
+            #Ordenadas, las rotaciones con un mismo prefijo quedan juntas y se buscan con busqueda binaria
+            #(si ya habia rotaciones ordenadas, sort solo tiene que fusionar las nuevas)
+            permus.sort()
+            self.ptindex[k] = permus
+
+
+    def make_bitmaps(self, terms=None):
+        """
+        Crea los mapas de bits (self.bindex) de los terminos densos, los que aparecen en al menos
+        1 de cada self.BITMAP_RATIO noticias. Sus posting lists siguen en self.index.
+        param:
+            -terms: diccionario campo --> terminos cuyo mapa de bits hay que rehacer,
+                    para la indexacion incremental. Por defecto todos. Deben estar todos los terminos
+                    con noticias nuevas: aunque ya no sean densos pueden tener un mapa de bits antiguo
+        """
+        dense = len(self.news) / self.BITMAP_RATIO
+        if terms is None:
+            self.bindex = {}
+            terms = self.index
+        for field, aux in terms.items():
+            bindex = self.bindex.setdefault(field, {})
+            for term in aux:
+                plist = self.index[field][term]
+                if len(plist) >= dense:
+                    bindex[term] = Bitmap.from_posting(plist)
+                else:
+                    #Con mas noticias el umbral sube, el mapa de bits que tuviera ya no tiene las nuevas
+                    bindex.pop(term, None)
+
+
+    def make_ranges(self):
+        """
+        Crea el indice de rangos (self.rindex) de los campos que no se tokenizan, como la fecha:
+        sus valores ordenados y, para cada uno, su posting list comprimida en tramos de newids consecutivos.
+        Los ficheros se indexan en orden (ver self.list_files), asi las noticias de un dia suelen ser un unico tramo
+        y las de un rango de fechas tramos contiguos.
+        """
+        self.rindex = {}
+        for field, tokenize in self.fields:
+            if tokenize or field not in self.index:
+                continue
+            values = sorted(self.index[field])
+            runs = []
+            for value in values:
+                aux = []
+                for newid in self.index[field][value]:
+                    if aux and aux[-1][1] == newid - 1:
+                        aux[-1] = (aux[-1][0], newid)
                     else:
-                        #Si está
-                        self.ptindex[k][permu].append(term)    
+                        aux.append((newid, newid))
+                runs.append(aux)
+            self.rindex[field] = (values, runs)
 
 
     def show_stats(self):
@@ -337,6 +1124,10 @@ class SAR_Project:
             print("-"*40)
             print("PERMUTERMS:")
             print("# of permuterms in 'article:'",len(self.ptindex['article']))
+        print("-"*40)
+        print("BITMAPS:")
+        for field in self.bindex:
+            print("# of dense terms stored as bitmaps in '%s':" % field, len(self.bindex[field]))
         if self.use_stemming:
             print("-"*40)
             print("STEMS:")
@@ -363,6 +1154,9 @@ class SAR_Project:
         Resuelve una query.
         Debe realizar el parsing de consulta que sera mas o menos complicado en funcion de la ampliacion que se implementen
 
+        La query se convierte en un arbol (self.parse_query), se reescribe (self.optimize_query)
+        y se evalua (self.eval_query) reutilizando las subexpresiones repetidas y las de queries
+        anteriores que siguen en la cache (self.get_query_cache).
 
         param:  "query": cadena con la query
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
@@ -372,103 +1166,341 @@ class SAR_Project:
 
         """
         
+        node = self.query_node(query)
+        if node is None:
+            return array(POSTING_TYPE)
+        return self.eval_query(node, self.get_query_cache())
+
+
+    def query_node(self, query):
+        """
+        Convierte una query en su arbol optimizado (self.parse_query y self.optimize_query).
+        param:
+            -query: cadena con la query
+        return:
+            -raiz del arbol optimizado, None si la query no tiene terminos
+        """
         if query is None or len(query) == 0:
-            return []
-        #Obtenemos término y operando
-        newquery = re.split(' ', query)
-        #Pila donde almacenamos los operandos que vamos viendo
-        pila = []
-        #Posting list del primer término
-        first = []
-        #Posting list del segundo término
-        second = []
-        #Contador para saber si hemos encontrador paréntesis
-        parentesis = 0
-        #Creamos una pila para almacenar la subconsulta si es necesario de cara a los paréntesis
-        pilap = []
-        #Hay que hacer todos los términos de la consulta
-        while newquery != []:
-            #Sacamos el token de la query
-            var = newquery.pop(0)
-            #Hemos encontrado un token
-            if var not in ['AND','OR','NOT']:
-                if '(' in var:
-                    #Añadimos todos los parénetesis que tenga el término a su derecha
-                    parentesis += var.count('(')
-                    #Apilamos
-                    pilap.append(var)
-                    #Quizás el término tiene paréntesis a la derecha, por ejemplo ((valencia)), por lo tanto eso es un único término
-                    if ')' in var:
-                        parentesis -= var.count(')')
-                    #Mientras que no hayamos encontrado la subconsulta entera
-                    while parentesis > 0:
-                        #Sacamos el siguiente elemento de la lista
-                        var = newquery.pop(0)
-                        #Se abre otra subconsulta dentro de la subconsulta, la función recursiva
-                        #lo resolverá
-                        if '(' in var:
-                            #Contamos el total que haya
-                            parentesis += var.count('(')
-                        #Se cierra subconsulta
-                        elif ')' in var:
-                            #Contamos cuantos tiene 
-                            parentesis -= var.count(')')
-                        #Metemos el token de la consulta
-                        pilap.append(var)
-                    #Quitamos el paréntesis inicial del primer token
-                    pilap[0] = pilap[0][1:]
-                    #Quitamos el paréntesis del final del segundo token
-                    pilap[-1] =  pilap[-1][:-1]
-                    #Almacenamos el resultado de la subconsulta y
-                    #resolvemos de forma recursiva
-                    aux = self.solve_query(' '.join(pilap))
-                    #Limpiamos la pila de operaciones de paréntesis
-                    pilap = []
-                    #No hemos visto operandos previamente
-                    if pila == []:
-                        first = aux
-                    #Los hemos visto anteriormente, hay que operar
-                    else: 
-                        second = aux
-                    #Si no hemos visto ningún operando => primer token
-                elif pila == []:
-                    if ':' in var: #comprobamos si es de un campo específico
-                        j = var.rfind(':') #obtenemos la posición de :
-                        campo = var[:j] #separamos el campo
-                        termino = var[j+1:] #separamos el término
-                        first = self.get_posting(termino, campo)
-
-                    else: first = self.get_posting(var)
-                    #Hemos encontrado operandos previamente
+            return None
+        tree = self.parse_query(query)
+        if tree is None:
+            return None
+        return self.optimize_query(tree)
+
+
+    def query_leaves(self, node):
+        """
+        Devuelve las hojas (terminos, frases y rangos) de un arbol optimizado.
+        param:
+            -node: nodo optimizado (ver self.optimize_query)
+        return:
+            -conjunto de hojas
+        """
+        if node[0] in ('term', 'phrase', 'range'):
+            return {node}
+        if node[0] == 'not':
+            return self.query_leaves(node[1])
+        return set().union(*(self.query_leaves(child) for child in node[1]))
+
+
+    def solve_batch(self, queries, jobs=1):
+        """
+        Resuelve una lista de queries de una vez. Se parsean todas antes de evaluar ninguna y se recupera
+        una sola vez la posting list de cada termino distinto (con su stemming o comodines), que comparten
+        todas las queries igual que las subexpresiones repetidas.
+        param:
+            -queries: lista de cadenas con las queries
+            -jobs: nº de procesos, con mas de 1 las queries se reparten en grupos consecutivos
+        return:
+            -lista con la posting list del resultado de cada query, en el mismo orden
+        """
+        if jobs > 1 and len(queries) > 1:
+            return self.solve_batch_parallel(queries, jobs)
+        nodes = [self.query_node(query) for query in queries]
+        #Las subexpresiones tambien se buscan y se guardan en la cache de queries
+        memo = BatchMemo(self.get_query_cache())
+        leaves = set().union(*(self.query_leaves(node) for node in nodes if node is not None))
+        for leaf in leaves:
+            self.eval_query(leaf, memo)
+        return [array(POSTING_TYPE) if node is None else self.eval_query(node, memo) for node in nodes]
+
+
+    def solve_batch_parallel(self, queries, jobs):
+        """
+        Reparte las queries de self.solve_batch en grupos consecutivos entre "jobs" procesos.
+        Cada proceso recibe una copia del indice al arrancar (con fork no se copia, se hereda).
+        Las queries cuyo resultado ya esta en la cache de queries no se envian a los procesos,
+        y los resultados que devuelven se guardan en ella.
+        """
+        return self.cached_batch(queries, lambda pending: self.solve_batch_chunks(pending, jobs))
+
+
+    def solve_batch_chunks(self, queries, jobs):
+        """
+        Resuelve las queries repartidas en grupos consecutivos entre "jobs" procesos (ver self.solve_batch_parallel).
+        """
+        jobs = min(jobs, len(queries))
+        size = -(-len(queries) // jobs)
+        chunks = [queries[i:i + size] for i in range(0, len(queries), size)]
+        results = []
+        with ProcessPoolExecutor(max_workers=len(chunks), initializer=init_batch, initargs=(self,)) as executor:
+            for part in executor.map(solve_batch_chunk, chunks):
+                results.extend(part)
+        return results
+
+
+    def cached_batch(self, queries, solve):
+        """
+        Resuelve un lote de queries pasando por la cache de queries, para los casos en los que no se evaluan
+        con self.eval_query en este proceso. Cada query distinta se busca una vez en la cache y solo las que
+        no estan se resuelven, una vez cada una; sus resultados se guardan en la cache y las repetidas
+        se sacan de ella, como en self.solve_query.
+        param:
+            -queries: lista de cadenas con las queries
+            -solve: funcion que recibe una lista de queries y devuelve la lista de sus resultados
+        return:
+            -lista con la posting list del resultado de cada query, en el mismo orden
+        """
+        cache = self.get_query_cache()
+        nodes = [self.query_node(query) for query in queries]
+        results = [None] * len(queries)
+        pending = {} # nodo --> primera query con ese nodo que no esta en la cache
+        for i, node in enumerate(nodes):
+            if node is None:
+                results[i] = array(POSTING_TYPE)
+            elif node not in pending:
+                results[i] = cache.get(node)
+                if results[i] is None:
+                    pending[node] = i
+        if not pending:
+            return results
+        solved = dict(zip(pending, solve([queries[i] for i in pending.values()])))
+        for node, res in solved.items():
+            cache[node] = res
+        for i, node in enumerate(nodes):
+            if results[i] is None:
+                res = cache.get(node) if pending[node] != i else None
+                results[i] = solved[node] if res is None else res
+        return results
+
+
+    def tokenize_query(self, query):
+        """
+        Separa una query en tokens: parentesis, operadores y terminos (con su campo si lo tienen).
+        param:
+            -query: cadena con la query
+        return:
+            -lista de tokens
+        """
+        return self.query_tokenizer.findall(query)
+
+
+    def parse_query(self, query):
+        """
+        Convierte una query en un arbol de tuplas:
+            ('term', campo, termino), ('phrase', campo, terminos), ('range', campo, desde, hasta), ('not', hijo),
+            ('and', hijo1, hijo2), ('or', hijo1, hijo2)
+        Los operadores AND y OR tienen la misma prioridad y se asocian de izquierda a derecha,
+        NOT se aplica sobre el operando que le sigue.
+        Dos operandos seguidos sin operador entre ellos se unen con AND.
+        param:
+            -query: cadena con la query
+        return:
+            -raiz del arbol, None si la query no tiene terminos
+        """
+        tokens = []
+        #Quitamos los parentesis de cierre que no tienen uno de apertura
+        depth = 0
+        for token in self.tokenize_query(query):
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                if depth == 0:
+                    continue
+                depth -= 1
+            tokens.append(token)
+        #Posicion del siguiente token, en una lista para poder modificarla desde las funciones internas
+        pos = [0]
+
+        def parse_expr():
+            left = parse_unary()
+            while pos[0] < len(tokens) and tokens[pos[0]] != ')':
+                op = tokens[pos[0]]
+                if op in ('AND', 'OR'):
+                    pos[0] += 1
+                else:
+                    op = 'AND'
+                right = parse_unary()
+                #Si falta algun operando, nos quedamos con el que haya
+                if right is None or left is None:
+                    left = left if right is None else right
+                else:
+                    left = (op.lower(), left, right)
+            return left
+
+        def parse_unary():
+            if pos[0] >= len(tokens):
+                return None
+            token = tokens[pos[0]]
+            pos[0] += 1
+            if token == 'NOT':
+                child = parse_unary()
+                return None if child is None else ('not', child)
+            if token == '(':
+                node = parse_expr()
+                #Saltamos el parentesis de cierre
+                if pos[0] < len(tokens):
+                    pos[0] += 1
+                return node
+            if token == ')':
+                return None
+            return self.parse_term(token)
+
+        return parse_expr()
+
+
+    def parse_term(self, token):
+        """
+        Convierte un token de la query en una hoja del arbol.
+        Las frases entre comillas ("isla de tenerife") se tokenizan como el texto de las noticias.
+        param:
+            -token: termino o frase de la query, puede llevar delante el campo separado por ':'
+        return:
+            -tupla ('term', campo, termino), ('phrase', campo, terminos) o ('range', campo, desde, hasta)
+        """
+        #Rango de valores de un campo sin tokenizar: date:[2015-03-01 TO 2015-03-31], * para no poner limite
+        match = self.query_range.fullmatch(token)
+        if match:
+            field, low, high = match.groups()
+            return ('range', field or 'date', '' if low == '*' else low, None if high == '*' else high)
+        if '"' in token:
+            q = token.index('"')
+            field = token[:q - 1] if q > 0 and token[q - 1] == ':' else 'article'
+            terms = tuple(self.tokenize(token[q + 1:].rstrip('"')))
+            if len(terms) != 1:
+                return ('phrase', field, terms)
+            token = field + ':' + terms[0]
+        if ':' in token: #comprobamos si es de un campo específico
+            j = token.rfind(':') #obtenemos la posición de :
+            return ('term', token[:j], token[j+1:])
+        return ('term', 'article', token)
+
+
+    def optimize_query(self, node):
+        """
+        Reescribe el arbol de una query sin cambiar su resultado:
+            - las cadenas de AND y de OR se aplanan en un unico nodo con todos sus operandos,
+              ordenados de forma canonica para que las subexpresiones iguales tengan la misma clave
+            - los operandos repetidos de un AND o un OR se eliminan
+            - NOT NOT x se sustituye por x
+        param:
+            -node: nodo del arbol devuelto por self.parse_query
+        return:
+            -nodo reescrito, los AND y OR quedan como ('and', (hijos...)) y ('or', (hijos...))
+        """
+        op = node[0]
+        if op == 'not':
+            child = self.optimize_query(node[1])
+            if child[0] == 'not':
+                return child[1]
+            return ('not', child)
+        if op in ('and', 'or'):
+            children = set()
+            for child in node[1:]:
+                child = self.optimize_query(child)
+                #Aplanamos los hijos que son del mismo operador
+                if child[0] == op:
+                    children.update(child[1])
                 else:
-                    if ':' in var: #comprobamos si es de un campo específico
-                        j = var.rfind(':') #obtenemos la posición de :
-                        campo = var[:j] #separamos el campo
-                        termino = var[j+1:] #separamos el término
-                        second = self.get_posting(termino, campo)
-
-                    else: second = self.get_posting(var)
-                if pila != []:
-                    #Vamos haciendo operaciones
-                    while pila != []:
-                        #¿Cual es el ultimo operando?
-                        op = pila.pop()
-                        #Es un NOT, reverse a la segunda posting list
-                        if op == 'NOT':
-                            second = self.reverse_posting(second)
-                        #Es  un AND, hacemos and_posting
-                        elif op == 'AND':
-                            second = self.and_posting(first,second)
-                        #Es un OR, hacemos or_posting
-                        else:
-                            second = self.or_posting(first,second)
-                    #Guardamos el resultado para más operaciones OwO
-                    first = second
-                #Se trata de un operando, lo añadimos a la pila
+                    children.add(child)
+            if len(children) == 1:
+                return children.pop()
+            return (op, tuple(sorted(children, key=repr)))
+        return node
+
+
+    def estimate_query(self, node, memo):
+        """
+        Estima el nº de noticias que devuelve un nodo sin evaluar sus operadores,
+        solo recuperando las posting lists de sus terminos.
+        param:
+            -node: nodo optimizado (ver self.optimize_query)
+            -memo: diccionario nodo --> posting list ya calculada
+        return:
+            -cota superior del nº de resultados
+        """
+        if node in memo or node[0] in ('term', 'phrase', 'range'):
+            return len(self.eval_query(node, memo))
+        if node[0] == 'not':
+            #N menos la cota superior del hijo seria una cota inferior, la unica cota superior sin evaluarlo es N
+            return len(self.news)
+        sizes = [self.estimate_query(child, memo) for child in node[1]]
+        if node[0] == 'and':
+            return min(sizes)
+        return min(len(self.news), sum(sizes))
+
+
+    def eval_query(self, node, memo):
+        """
+        Evalua un nodo del arbol de una query.
+            - AND: se intersectan primero los operandos con menos resultados estimados y se para
+              en cuanto el resultado es vacio. Los operandos NOT se restan con self.minus_posting
+              sin calcular su complementario. Si todos son NOT se aplica De Morgan: NOT (a OR b ...)
+            - OR: se unen empezando por las posting lists mas cortas
+        param:
+            -node: nodo optimizado (ver self.optimize_query)
+            -memo: diccionario (o QueryCache) nodo --> posting list, para no evaluar dos veces la misma subexpresion
+        return:
+            -posting list con el resultado
+        """
+        res = memo.get(node)
+        if res is not None:
+            return res
+        op = node[0]
+        if op == 'term':
+            res = self.get_posting(node[2], node[1])
+        elif op == 'phrase':
+            res = self.get_positionals(list(node[2]), node[1])
+        elif op == 'range':
+            res = self.get_range(node[2], node[3], node[1])
+        elif op == 'not':
+            res = self.reverse_posting(self.eval_query(node[1], memo))
+        elif op == 'or':
+            plists = sorted((self.eval_query(child, memo) for child in node[1]), key=len)
+            res = plists[0]
+            for p in plists[1:]:
+                res = self.or_posting(res, p)
+        else:
+            positives = [child for child in node[1] if child[0] != 'not']
+            negatives = [child[1] for child in node[1] if child[0] == 'not']
+            if not positives:
+                #NOT a AND NOT b == NOT (a OR b). Los hijos ya estan optimizados, construimos el OR
+                #directamente en forma canonica, aplanando los que ya son OR
+                children = set()
+                for child in negatives:
+                    if child[0] == 'or':
+                        children.update(child[1])
+                    else:
+                        children.add(child)
+                if len(children) == 1:
+                    union = children.pop()
+                else:
+                    union = ('or', tuple(sorted(children, key=repr)))
+                res = self.eval_query(('not', union), memo)
             else:
-                pila.append(var)
-        #Devolvemos el resultado
-        return first
+                positives.sort(key=lambda child: self.estimate_query(child, memo))
+                res = self.eval_query(positives[0], memo)
+                for child in positives[1:]:
+                    if len(res) == 0:
+                        break
+                    res = self.and_posting(res, self.eval_query(child, memo))
+                for child in negatives:
+                    if len(res) == 0:
+                        break
+                    res = self.minus_posting(res, self.eval_query(child, memo))
+        memo[node] = res
+        return res
+
  
     def get_posting(self, term, field='article'):
         """
@@ -487,17 +1519,79 @@ class SAR_Project:
         return: posting list
 
         """
+        if field == self.ANY_FIELD:
+            return self.get_any_posting(term)
         #La opción de activar el stemming está activa:
         if ('*' in term or '?' in term) and self.permuterm:
             plist = self.get_permuterm(term,field)
         elif self.use_stemming:
             plist = self.get_stemming(term,field) #Devolvemos la posting list del término dentro del campo
         else:
-            flist = self.index.get(field,{}) #Sacamos el diccionario de campo 'field'
-            plist = flist.get(term,[]) #Devolvemos la posting list del término dentro del campo
+            plist = self.get_term_posting(term, field)
         return plist
 
 
+    def get_range(self, low, high, field='date'):
+        """
+        Devuelve las noticias cuyo valor de un campo sin tokenizar (la fecha) esta entre "low" y "high", incluidos.
+        Los valores se buscan con busqueda binaria en self.rindex y el resultado se construye como mapa de bits
+        a partir de los tramos de newids consecutivos, asi un rango de fechas es una mascara que se usa
+        directamente en los AND.
+        param:
+            -low: valor minimo, '' para no poner limite
+            -high: valor maximo, None para no poner limite
+            -field: campo del indice
+        return:
+            -posting list (Bitmap)
+        """
+        if field not in self.rindex:
+            return array(POSTING_TYPE)
+        values, runs = self.rindex[field]
+        start = bisect_left(values, low)
+        end = len(values) if high is None else bisect_right(values, high)
+        #Juntamos los tramos contiguos antes de crear las mascaras
+        merged = []
+        for first, last in sorted(run for aux in runs[start:end] for run in aux):
+            if merged and merged[-1][1] >= first - 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        bits = 0
+        for first, last in merged:
+            bits |= ((1 << (last - first + 1)) - 1) << first
+        return Bitmap(bits)
+
+
+    def get_any_posting(self, term):
+        """
+        Devuelve la posting list de un termino en cualquier campo (query "any:termino").
+        Se sacan de una vez los terminos del indice de todos los campos (con stemming o comodines,
+        ver self.expand_term) y todas sus posting lists se unen en una unica fusion k-way.
+        param:
+            -term: termino de la query
+        return:
+            -posting list
+        """
+        return self.or_postings([self.get_term_posting(t, field) for field in self.index
+                                 for t in self.expand_term(term, field)])
+
+
+    def get_term_posting(self, term, field='article'):
+        """
+        Devuelve la posting list de un termino tal cual esta en el indice, sin stemming ni comodines.
+        Si el termino es denso devuelve su mapa de bits.
+        param:
+            -term: termino
+            -field: campo del indice
+        return:
+            -posting list (array o Bitmap), vacia si el termino no esta en el campo
+        """
+        bitmap = self.bindex.get(field, {}).get(term)
+        if bitmap is not None:
+            return bitmap
+        return self.index.get(field, {}).get(term, array(POSTING_TYPE))
+
+
     def get_positionals(self, terms, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE POSICIONALES
@@ -510,10 +1604,61 @@ class SAR_Project:
         return: posting list
 
         """
-        pass
-        ########################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE POSICIONALES ##
-        ########################################################
+        if field == self.ANY_FIELD:
+            return self.or_postings([self.get_positionals(terms, f) for f in self.pindex])
+        #Sin indice posicional para el campo no se pueden resolver frases
+        if len(terms) == 0 or field not in self.pindex:
+            return array(POSTING_TYPE)
+        plists = []
+        for term in terms:
+            plist = self.index[field].get(term)
+            if plist is None:
+                return array(POSTING_TYPE)
+            plists.append(plist)
+        #Primero las noticias que tienen todos los terminos, empezando por la lista mas corta
+        shortest = sorted(plists, key=len)
+        candidates = shortest[0]
+        for plist in shortest[1:]:
+            candidates = self.and_posting(candidates, plist)
+        #Offsets y posiciones codificadas de cada termino
+        positions = [self.pindex[field][term] for term in terms]
+        plres = array(POSTING_TYPE)
+        #Por cada termino, a partir de donde buscamos la noticia en su posting list
+        starts = [0] * len(terms)
+        for newid in candidates:
+            #Posiciones en las que podria empezar la frase
+            begin = None
+            for k, plist in enumerate(plists):
+                i = bisect_left(plist, newid, starts[k])
+                starts[k] = i + 1
+                #Solo decodificamos las posiciones de las noticias candidatas
+                offsets, data = positions[k]
+                end = offsets[i + 1] if i + 1 < len(offsets) else len(data)
+                shifted = {pos - k for pos in decode_positions(data, offsets[i], end)}
+                begin = shifted if begin is None else begin & shifted
+                if not begin:
+                    break
+            if begin:
+                plres.append(newid)
+        return plres
+
+
+    def stem(self, term):
+        """
+        Devuelve el stem de un termino. Los del vocabulario del indice se sacan de self.stems, calculados
+        una vez al indexar; para el resto se llama al stemmer a traves de una cache LRU de self.STEM_CACHE terminos.
+        param:
+            -term: termino
+        return:
+            -stem del termino
+        """
+        stem = self.stems.get(term)
+        if stem is not None:
+            return stem
+        if self.stemcache is None:
+            self.stemcache = lru_cache(maxsize=self.STEM_CACHE)(self.stemmer.stem)
+        return self.stemcache(term)
+
 
     def get_stemming(self, term, field='article'):
         """
@@ -528,22 +1673,14 @@ class SAR_Project:
 
         """
         #Sacamos el stem del término
-        stem = self.stemmer.stem(term)
+        stem = self.stem(term)
+        #Si se ha guardado la posting list de cada stem, basta con buscarla
+        if field in self.spindex:
+            return self.spindex[field].get(stem, array(POSTING_TYPE))
         #obtener posting list si existe
-        aux = self.sindex[field].get(stem,[])
-        #Si aux está vacía, devolvemos la lista vacía que está en aux
-        if len(aux) == 0:
-            return aux
-        #Asignamos a res la lista del primer término 
-        res = self.index[field][aux[0]]
-        #Recorremos la lista y vamos aplicando la operación OR
-        for i in range(1,len(aux)):
-            #Posting list del siguiente término
-            var = self.index[field][aux[i]]
-            #OR_posting
-            res = self.or_posting(res,var)
-        #Devolvemos el resultado
-        return res
+        aux = self.sindex.get(field, {}).get(stem,[])
+        #Unimos las posting lists de todos los términos del stem de una vez
+        return self.or_postings([self.get_term_posting(t, field) for t in aux])
 
     def get_permuterm(self, term, field='article'):
         """
@@ -557,19 +1694,9 @@ class SAR_Project:
         return: posting list
 
         """
-        pl = self.obtener_claves_permu(term)
-        if pl == []:
-            return pl
-        #Asignamos a res la lista del primer término 
-        res = self.index[field][pl[0]]
-        #Recorremos la lista y vamos aplicando la operación OR
-        for i in range(1,len(pl)):
-            #Posting list del siguiente término
-            var = self.index[field][pl[i]]
-            #OR_posting
-            res = self.or_posting(res,var)
-        #Devolvemos el resultado
-        return res
+        pl = self.obtener_claves_permu(term, field)
+        #Unimos las posting lists de todos los términos de una vez
+        return self.or_postings([self.get_term_posting(t, field) for t in pl])
 
     def obtener_claves_permu(self,term,field='article'):
         """Devuelve la lista de términos asociado a un permuterm
@@ -585,17 +1712,18 @@ class SAR_Project:
         while term[-1] != '?' and term[-1] != '*':
             #Rota término
             term = term[1:] + term[0]
-        #Devolvemos la posting list de todos los términos cuyo prefijo sea este
-        claves = [t for t in self.ptindex[field].keys() if (term[:-1] == t[:len(term[:-1])])]
-        #La longitud sería la misma ( el ? actúa como un único char)
-        if '?' == term[-1]: 
-            #Lista intensional que comprueba si de los permuterms tienen la misma longitud ( el ? es solo un char)
-            claves = [t for t in claves if len(t) == len(term)]
+        prefix = term[:-1]
+        permus = self.ptindex.get(field, [])
+        #Las rotaciones que empiezan por el prefijo estan seguidas a partir de la primera que no es menor que el
+        i = bisect_left(permus, prefix)
         pl = []
-        #Sacamos todos los términos de cada clave
-        for k in claves:
-            #Añadimos los términos a una lista
-            pl.extend(self.ptindex[field][k])
+        while i < len(permus) and permus[i].startswith(prefix):
+            #La longitud sería la misma ( el ? actúa como un único char)
+            if '?' != term[-1] or len(permus[i]) == len(term):
+                #Deshacemos la rotacion para recuperar el termino
+                j = permus[i].index('$')
+                pl.append(permus[i][j+1:] + permus[i][:j])
+            i += 1
         return pl
         
 
@@ -608,27 +1736,10 @@ class SAR_Project:
         return: posting list con todos los newid exceptos los contenidos en p
 
         """
-        #Recuperamos el nº total de noticias que hay
-        allnews = [i+1 for i in range(len(self.news))]
-        #Posting list resultante 
-        pres = []
-        i = 0
-        j = 0
-        while i < len(p) and j < len(allnews):
-            #Si son el mismo término,incrementamos todo en 1 y no añadimos nada al resultado
-            if p[i] == allnews[j]:
-                i += 1
-                j += 1
-            #Caso alternativo: allnews[j] < p[i], entonces añadimos el término allnews[j]
-            elif allnews[j] < p[i]:
-                pres.append(allnews[j])
-                j+=1
-            #No se puede dar el caso de que p[i] < allnews[j]
-        #Si quedan términos sin visitar
-        while j < len(allnews):
-            pres.append(allnews[j])
-            j += 1
-        return pres
+        #El complementario es casi siempre denso: lo calculamos como mapa de bits con un XOR
+        #sobre la mascara de todas las noticias (bits 1..N)
+        allbits = (1 << (len(self.news) + 1)) - 2
+        return Bitmap(allbits ^ Bitmap.from_posting(p).bits)
 
     def and_posting(self, p1, p2):
         """
@@ -636,18 +1747,57 @@ class SAR_Project:
 
         Calcula el AND de dos posting list de forma EFICIENTE
 
+        Si una lista es mucho mas corta que la otra (ver self.GALLOP_RATIO) se busca cada newid
+        de la corta en la larga con busqueda exponencial (galloping), en lugar de recorrer la larga entera.
+
         param:  "p1", "p2": posting lists sobre las que calcular
 
 
         return: posting list con los newid incluidos en p1 y p2
 
+        """
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return self.bitmap_and_posting(p1, p2)
+        #Nos aseguramos de que p1 es la mas corta
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        if len(p1) * self.GALLOP_RATIO < len(p2):
+            return self.gallop_and_posting(p1, p2)
+        return self.merge_and_posting(p1, p2)
+
+
+    def bitmap_and_posting(self, p1, p2):
+        """
+        AND de dos posting lists cuando al menos una es un mapa de bits.
+        Si las dos lo son es un AND bit a bit, si no se filtran los newid del array
+        consultando el mapa de bits en O(1).
+
+        param:  "p1", "p2": posting lists sobre las que calcular
+
+        return: posting list con los newid incluidos en p1 y p2
+        """
+        if isinstance(p1, Bitmap) and isinstance(p2, Bitmap):
+            return Bitmap(p1.bits & p2.bits)
+        if isinstance(p1, Bitmap):
+            p1, p2 = p2, p1
+        return array(POSTING_TYPE, [x for x in p1 if x in p2])
+
+
+    def merge_and_posting(self, p1, p2):
+        """
+        AND de dos posting lists recorriendo ambas a la vez, O(len(p1) + len(p2)).
+        Es la mejor opcion cuando las dos listas tienen longitudes parecidas.
+
+        param:  "p1", "p2": posting lists sobre las que calcular
+
+        return: posting list con los newid incluidos en p1 y p2
         """
         #Indice con el que recorrer la p1
         i = 0
         #Indice con el que recorrer la p2
         j = 0
         #Posting list a devolver
-        plres = []
+        plres = array(POSTING_TYPE)
         #Iteramos en el bucle while mientras no nos salgamos de las listas
         while i < len(p1) and j < len(p2):
             #Si los punteros apuntan al mismo nº, lo añadimos a la posting list
@@ -667,6 +1817,35 @@ class SAR_Project:
         #Devolvemos la posting list resultante
         return plres
 
+    def gallop_and_posting(self, p1, p2):
+        """
+        AND de dos posting lists buscando cada newid de "p1" en "p2" con busqueda exponencial
+        a partir de la ultima posicion encontrada, O(len(p1) * log(len(p2) / len(p1))).
+        Es la mejor opcion cuando "p1" es mucho mas corta que "p2".
+
+        param:  "p1": posting list corta
+                "p2": posting list larga
+
+        return: posting list con los newid incluidos en p1 y p2
+        """
+        plres = array(POSTING_TYPE)
+        #Posicion de p2 a partir de la que buscamos
+        j = 0
+        n = len(p2)
+        for x in p1:
+            #Doblamos el salto hasta pasarnos de x o salirnos de la lista
+            step = 1
+            while j + step < n and p2[j + step] < x:
+                step *= 2
+            #x esta entre j + step/2 y j + step, busqueda binaria en ese tramo
+            j = bisect_left(p2, x, j + step // 2, min(j + step + 1, n))
+            if j == n:
+                break
+            if p2[j] == x:
+                plres.append(x)
+                j += 1
+        return plres
+
     def or_posting(self, p1, p2):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -679,12 +1858,15 @@ class SAR_Project:
         return: posting list con los newid incluidos de p1 o p2
 
         """
+        #Si alguna es un mapa de bits el resultado sera denso: OR bit a bit
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            return Bitmap(Bitmap.from_posting(p1).bits | Bitmap.from_posting(p2).bits)
         #Indice con el que recorrer la p1
         i = 0
         #Indice con el que recorrer la 
         j = 0
         #Posting list a devolver
-        plres = []
+        plres = array(POSTING_TYPE)
         while i < len(p1)  and j <len(p2):
             #Si p1[i] == p2[j] añadimos solo 1
             if p1[i] == p2[j]:
@@ -708,6 +1890,35 @@ class SAR_Project:
             j += 1
         return plres
 
+    def or_postings(self, plists):
+        """
+        Calcula el OR de varias posting lists a la vez.
+        Las listas se fusionan con un heap (k-way merge) en O(n log k), en lugar de ir haciendo
+        OR de dos en dos copiando cada vez el resultado acumulado. Si hay mapas de bits, OR bit a bit.
+
+        param:  "plists": lista de posting lists
+
+        return: posting list con los newid incluidos en alguna de las listas
+        """
+        if len(plists) == 0:
+            return array(POSTING_TYPE)
+        if len(plists) == 1:
+            return plists[0]
+        if any(isinstance(p, Bitmap) for p in plists):
+            bits = 0
+            for p in plists:
+                bits |= Bitmap.from_posting(p).bits
+            return Bitmap(bits)
+        plres = array(POSTING_TYPE)
+        #Los newid empiezan en 1
+        last = 0
+        for newid in heapq.merge(*plists):
+            if newid != last:
+                plres.append(newid)
+                last = newid
+        return plres
+
+
     def minus_posting(self, p1, p2):
         """
         OPCIONAL PARA TODAS LAS VERSIONES
@@ -721,12 +1932,36 @@ class SAR_Project:
         return: posting list con los newid incluidos de p1 y no en p2
 
         """
-        #A EXCEPT B se traduce como A AND NOT B, por lo tanto es tan sencillo como devolver 
-        p2 = self.reverse_posting(p2)
-        #A AND NOT B lo hacemos
-        pres = self.and_posting(p1,p2)
-        #Devolvemos el la posting list de resultado
-        return pres
+        #A EXCEPT B es A AND NOT B, pero lo calculamos directamente sin construir el complementario de B
+        if isinstance(p1, Bitmap):
+            return Bitmap(p1.bits & ~Bitmap.from_posting(p2).bits)
+        if isinstance(p2, Bitmap):
+            return array(POSTING_TYPE, [x for x in p1 if x not in p2])
+        plres = array(POSTING_TYPE)
+        #Si p1 es mucho mas corta, buscamos cada newid de p1 en p2 con busqueda binaria
+        if len(p1) * self.GALLOP_RATIO < len(p2):
+            j = 0
+            for x in p1:
+                j = bisect_left(p2, x, j)
+                if j == len(p2) or p2[j] != x:
+                    plres.append(x)
+            return plres
+        i = 0
+        j = 0
+        while i < len(p1) and j < len(p2):
+            #Esta en las dos, no se añade
+            if p1[i] == p2[j]:
+                i += 1
+                j += 1
+            #Solo esta en p1, se añade
+            elif p1[i] < p2[j]:
+                plres.append(p1[i])
+                i += 1
+            else:
+                j += 1
+        #Lo que queda de p1 no esta en p2
+        plres.extend(p1[i:])
+        return plres
 
 
 
@@ -769,8 +2004,6 @@ class SAR_Project:
         return: el numero de noticias recuperadas, para la opcion -T
         
         """
-        #Tokenizer 2
-        tok = re.compile(r'AND|OR|NOT')
         #Posting list resultante
         result = self.solve_query(query)
         #Arreglamos el string
@@ -778,125 +2011,315 @@ class SAR_Project:
         #Imprimimos la query
         print("Query:",aux)
         #Imprimimos longitud posting list
-        number = len(result)
-        print("Number of results:",number)
-        #Asignamos score predeterminada
-        score = 0
-        #Está activado show all?
-        number = self.SHOW_MAX if not self.show_all and self.SHOW_MAX < number else number
+        print("Number of results:",len(result))
+        ranked = self.shown_results(result, query)
+        number = len(ranked)
+        #Se recuperan todas las noticias de una vez, ver self.get_news
+        news = self.get_news([noticia for noticia, score in ranked])
         #Recorremos cada documento
         for i in range(number):
             #Imprimimos el nº de resultado
             print("#" + str(i+1))
-            #Si usamos score, actualizamos
-            if self.use_ranking:
-                score = self.rank_result(result, query)
+            #Sacamos cual es la noticia y su score
+            noticia, score = ranked[i]
             print("Score: ",score)
-            #Sacamos cual es la noticia
-            noticia = result[i]
             #Imprimimos el identificador de la noticia
             print("New ID: ", noticia)
-            #Sacamos el documento y posición en la que se encuentra la noticia
-            (docID,pos) = self.news[noticia]
-            #Sacamos el fichero
-            filename = self.docs[docID]
-            #Abrimos el documento
-            with open(filename) as fh:
-                jlist = json.load(fh)
-            #Guardamos la noticia en el documento en una variable
-            new = jlist[pos]
+            #Recuperamos la noticia
+            new = news[i]
             #Fecha
             print("Date: ",new['date'])
             print("Title: ",new['title'])
             print("Keywords: ",new['keywords'])
             if self.show_snippet:
-                snippet = self.get_summary(self.tokenize(new['article']),tok.sub('',query).split())
-                print(snippet)
+                print(self.get_snippet(new, query, noticia))
         
         return number  
 
 
-    def get_summary(self,article,terms):
+    def shown_results(self, result, query):
         """
-        Muestra un snippet de una articulo de acuerdo a unos términos que aparecen en este
-        Consideraciones: Si dos términos se encuentran muy juntos, los muestra en una frase, si hay distancia entre
-        varios términos usa ... para separarlos
+        Devuelve las noticias de un resultado que se muestran: todas o las self.SHOW_MAX primeras
+        segun self.show_all, ordenadas con self.rank_result si esta activado el ranking.
         param:
-        -article: El articulo en cuestión
-        -terms: Lista con los términos
+            -result: posting list con el resultado de la query
+            -query: query original
         return:
-        El fragmento de texto en cuestión
+            -lista de tuplas (newid, score)
         """
-        #Variables auxiliares, en terms y article se mantiene el contenido original para que el bucle for funcione
-        #Por si es subconsulta, eliminamos paréntesis
-        #además no tiene sentido buscar términos que estáne n otros fields
-        terms2 = [re.sub(r'\(|\)','',a) for a in terms if ':' not in a]
-        #article original
-        article2 = article
-        #Si usamos stemming aplicamos stemming a los tokens de ambas listas con un map
-        if self.use_stemming:
-            terms2 = list(map(self.stemmer.stem,terms))
-            article2 = list(map(self.stemmer.stem,article))
-        #Almacenamos la aparición
-        indexes = [(x,article2.index(x)) for x in terms2 if x in article2]
-        if self.permuterm:
-            #Sacamos todos los términos de la consulta con wildcard
-            permus = [p for p in terms2 if '*' in p or '?' in p]
-            #variable auxiliar, guarda todos los términos del permuterm
-            aux = []
-            #Vamos añadiendo por cada término con una consulta wildcard los términos que aparece en el permuterm
-            for p in permus:
-                aux.extend(self.obtener_claves_permu(p))
-            #(termino,posicions)
-            aux = [(x,article.index(x)) for x in aux if x in article]
-            indexes.extend(aux)
-            #Elimina términos repetidos
-            indexes = list(dict.fromkeys(indexes))
-        #Ordenamos por orden de aparición
-        indexes = sorted(indexes,key = lambda tup: tup[1])
-        #Snippet resultado
-        snippet = ''
-        #Variable booleana, explicada más abajo
-        seen = False
-        #Recorremos todos los índices excepto el último
-        for i in range(len(indexes) - 1):
-            #Índice del primer término
-            first = indexes[i]
-            #índice del siguiente término
-            last = indexes[i+1]
-            #Comprobamos si estamos al principio del texto
-            j = 3 if first[1] > 3 else 0
-            z = 3 
-            #Si estan a menos de 10 palabras entre ambos, pillamos la frase hasta ahí
-            if last[1] - first[1] < 10:
-                #Si hemos visto la de ahora, añadimos a partir de la siguiente palabra respecto a la de ahora
-                if seen:
-                    aux = ' '.join(article[first[1] + len(first[0]) + 1:last[1] + z]) + ' '
-                else:
-                    aux = ' '.join(article[first[1] - j:first[1]])+ ' ' + ' '.join(article[first[1]:last[1] + len(last[0])]) + ' '
-                #Hay dos palabras juntas 
-                seen = True
-            #La palabra de ahora ya está añadida y no podemos añadir la siguiente
-            elif seen:
-                #Solo ponemos '...'
-                aux = '...'
-                #No he añadido el término posterior
-                seen = False
-            #Simplemente añadimos 3 palabras a la izquierda y tres a la derecha 
+        #Está activado show all?
+        number = self.SHOW_MAX if not self.show_all and self.SHOW_MAX < len(result) else len(result)
+        #Las puntuaciones se calculan una sola vez para toda la query
+        if self.use_ranking:
+            return self.rank_result(result, query)[:number]
+        #Score predeterminada
+        return [(result[i], 0) for i in range(number)]
+
+
+    def get_new(self, newid):
+        """
+        Devuelve una noticia a partir de su newid.
+        Si hay almacen de noticias se lee de el en O(1), si no se lee el fichero del dia, que no se lee
+        (ni se descomprime) entero, solo hasta la noticia (ver self.read_cached).
+        En todos los casos las ultimas noticias leidas se guardan en una cache LRU.
+        Para varias noticias es mejor self.get_news, que lee de una vez las de cada fichero comprimido.
+        param:
+            -newid: identificador de la noticia
+        return:
+            -diccionario con los campos de la noticia
+        """
+        if self.use_docstore(newid):
+            return self.docreader.get(newid)
+        #Sacamos el documento y posición en la que se encuentra la noticia
+        (docID,pos) = self.news[newid]
+        filename = self.docs[docID]
+        return self.read_cached(filename, [pos])[pos]
+
+
+    def get_news(self, newids):
+        """
+        Devuelve varias noticias a partir de sus newids, en el mismo orden, igual que self.get_new.
+        Sin almacen de noticias, las de cada fichero de un dia se leen en una sola pasada,
+        asi cada fichero se lee (y descomprime) como mucho una vez aunque tenga varias de las noticias.
+        param:
+            -newids: lista de identificadores de noticias
+        return:
+            -lista de diccionarios con los campos de cada noticia
+        """
+        #Noticias de cada fichero: fichero --> posicion --> newid
+        days = {}
+        for newid in newids:
+            if not self.use_docstore(newid):
+                (docID,pos) = self.news[newid]
+                days.setdefault(self.docs[docID], {})[pos] = newid
+        found = {}
+        for filename, aux in days.items():
+            for pos, new in self.read_cached(filename, list(aux)).items():
+                found[aux[pos]] = new
+        return [found[newid] if newid in found else self.get_new(newid) for newid in newids]
+
+
+    def use_docstore(self, newid):
+        """
+        Indica si una noticia se lee del almacen de noticias, abriendolo la primera vez.
+        """
+        if self.docreader is None and self.docstore is not None and newid < len(self.doc_offsets) \
+                and os.path.exists(self.docstore):
+            self.open_docreader()
+        return self.docreader is not None and newid < len(self.doc_offsets)
+
+
+    def open_docreader(self):
+        """
+        Abre el almacen de noticias para leer, al pedir la primera noticia.
+        """
+        self.docreader = DocStore(self.docstore, self.doc_offsets, self.DOC_CACHE)
+
+
+    def read_cached(self, filename, positions):
+        """
+        Lee noticias de un fichero de un dia. Las que no estan en la cache (self.newcache, de como mucho
+        self.DOC_CACHE noticias) se leen todas en una sola pasada, que para en la ultima (ver SAR_input.read_news).
+        param:
+            -filename: fichero de noticias
+            -positions: posiciones de las noticias en el fichero
+        return:
+            -diccionario posicion --> noticia
+        """
+        if self.newcache is None:
+            self.newcache = QueryCache(self.DOC_CACHE)
+        found = {}
+        missing = []
+        for pos in positions:
+            new = self.newcache.get((filename, pos))
+            if new is None:
+                missing.append(pos)
             else:
-                #snippet+'...'
-                aux = ' '.join(article[first[1] - j: first[1] + z]) + '...'
-            #Añadimos a resultado
-            snippet += aux
-        #El último snippet si no esta en la misma frase que con el penúltimo, repetimos
-        print(indexes)
-        if not seen and indexes != []:
-            #Es el ultimo
-            aux = indexes[-1]
-            #Añadimos, no pasa nada si nos pasamos del texto por la dereccha python se encarga
-            snippet += ' '.join(article[aux[1] - 3:aux[1]]) + ' ' + ' '.join(article[aux[1]: aux[1] + 3])
+                found[pos] = new
+        if missing:
+            for pos, new in self.read_day_news(filename, missing).items():
+                self.newcache[(filename, pos)] = new
+                found[pos] = new
+        return found
+
+
+    def read_day_news(self, filename, positions):
+        """
+        Lee algunas noticias de un fichero de noticias de un dia, en una sola pasada (ver SAR_input.read_news).
+        param:
+            -filename: ruta del fichero
+            -positions: posiciones de las noticias en el fichero
+        return:
+            -diccionario posicion --> noticia
+        """
+        return read_news(filename, positions)
+
+
+    def get_snippet(self, new, query, newid=None):
+        """
+        Devuelve el snippet de una noticia para una query: los fragmentos del articulo en los que aparecen
+        mas terminos distintos de la query (los que no estan negados).
+        Si se conoce el newid y hay indice posicional, las apariciones se sacan de self.pindex; si no,
+        de una sola pasada por los tokens del articulo. En ningun caso se lee nada mas que la noticia.
+        param:
+            -new: diccionario con los campos de la noticia
+            -query: query original
+            -newid: identificador de la noticia, para usar el indice posicional
+        return:
+            -cadena con el snippet
+        """
+        groups = self.snippet_terms(query)
+        positions = None
+        if newid is not None:
+            positions = [self.term_positions(group, newid) for group in groups]
+        if positions is None or None in positions:
+            positions = self.scan_positions(new['article'], groups)
+        return self.get_summary(new['article'], positions)
+
+
+    def snippet_terms(self, query):
+        """
+        Devuelve los terminos del indice que se buscan en el articulo para el snippet.
+        param:
+            -query: query original
+        return:
+            -lista con un conjunto de terminos del indice por cada termino de la query del campo article
+             (o de todos los campos), ya expandidos con stemming o permuterm como en self.expand_term
+        """
+        tree = self.parse_query(query)
+        groups = {}
+        for field, term in (self.query_terms(tree) if tree is not None else []):
+            if field in ('article', self.ANY_FIELD):
+                groups.setdefault(term, set()).update(self.expand_term(term, 'article'))
+        return list(groups.values())
+
+
+    def term_positions(self, terms, newid, field='article'):
+        """
+        Devuelve las posiciones de unos terminos en una noticia a partir del indice posicional.
+        param:
+            -terms: terminos del indice
+            -newid: identificador de la noticia
+            -field: campo de la noticia
+        return:
+            -lista ordenada de posiciones, None si el campo no tiene indice posicional
+        """
+        if field not in self.pindex:
+            return None
+        positions = []
+        for term in terms:
+            plist = self.index[field].get(term)
+            if plist is None:
+                continue
+            i = bisect_left(plist, newid)
+            if i == len(plist) or plist[i] != newid:
+                continue
+            offsets, data = self.pindex[field][term]
+            end = offsets[i + 1] if i + 1 < len(offsets) else len(data)
+            positions.extend(decode_positions(data, offsets[i], end))
+        positions.sort()
+        return positions
+
+
+    def scan_positions(self, article, groups):
+        """
+        Devuelve las posiciones de los terminos de cada grupo en un articulo, recorriendo sus tokens una vez.
+        param:
+            -article: texto del articulo
+            -groups: lista de conjuntos de terminos (ver self.snippet_terms)
+        return:
+            -lista con las posiciones ordenadas de cada grupo
+        """
+        #Listas de posiciones de cada termino (un termino puede estar en varios grupos: c*sa y c?sa),
+        #asi cada token se comprueba con un solo acceso a un diccionario
+        positions = [[] for group in groups]
+        owner = {}
+        for plist, group in zip(positions, groups):
+            for term in group:
+                owner.setdefault(term, []).append(plist)
+        for pos, token in enumerate(self.tokenize(article)):
+            for plist in owner.get(token, ()):
+                plist.append(pos)
+        return positions
+
+
+    def best_window(self, occurrences):
+        """
+        Busca la ventana de menos de self.SNIPPET_WINDOW tokens con mas terminos distintos de la query
+        y, a igualdad, con mas apariciones; si hay varias, la primera. Recorre las apariciones una vez.
+        param:
+            -occurrences: lista ordenada de tuplas (posicion, grupo)
+        return:
+            -tupla (primera posicion, ultima posicion, conjunto de grupos de la ventana)
+        """
+        counts = Counter()
+        best = None
+        i = 0
+        for j, (pos, group) in enumerate(occurrences):
+            counts[group] += 1
+            #Sacamos por la izquierda las apariciones que quedan fuera de la ventana
+            while pos - occurrences[i][0] >= self.SNIPPET_WINDOW:
+                left = occurrences[i][1]
+                counts[left] -= 1
+                if not counts[left]:
+                    del counts[left]
+                i += 1
+            score = (len(counts), j - i + 1)
+            if best is None or score > best[0]:
+                best = (score, occurrences[i][0], pos, set(counts))
+        return best[1:]
+
+
+    def get_summary(self, article, positions):
+        """
+        Monta el snippet de un articulo: hasta self.SNIPPET_FRAGMENTS fragmentos, el primero la mejor ventana
+        (ver self.best_window) y los siguientes las mejores con los terminos que aun no se muestran.
+        Cada fragmento se amplia self.SNIPPET_CONTEXT tokens por cada lado y se separan con '...'.
+        Si no aparece ningun termino se muestra el principio del articulo.
+        param:
+            -article: texto del articulo
+            -positions: lista con las posiciones ordenadas de los terminos de cada grupo
+        return:
+            -cadena con el snippet
+        """
+        occurrences = list(heapq.merge(*[[(pos, i) for pos in plist] for i, plist in enumerate(positions)]))
+        windows = []
+        while occurrences and len(windows) < self.SNIPPET_FRAGMENTS:
+            first, last, groups = self.best_window(occurrences)
+            windows.append((max(first - self.SNIPPET_CONTEXT, 0), last + self.SNIPPET_CONTEXT))
+            occurrences = [occ for occ in occurrences if occ[1] not in groups]
+        if not windows:
+            windows.append((0, self.SNIPPET_WINDOW - 1))
+        #En orden del texto, juntando los fragmentos que se solapan
+        fragments = []
+        for first, last in sorted(windows):
+            if fragments and first <= fragments[-1][1] + 1:
+                fragments[-1][1] = max(fragments[-1][1], last)
+            else:
+                fragments.append([first, last])
+        #Los tokens salen de article.lower(): si cambia de longitud no se puede cortar el texto original
+        text = article.lower()
+        source = article if len(text) == len(article) else text
+        #Solo se buscan los tokens hasta el final del ultimo fragmento, saltando los de en medio con islice
+        matches = self.token_pattern.finditer(text)
+        read = 0
+        pieces = []
+        for first, last in fragments:
+            start = next(islice(matches, first - read, None), None)
+            if start is None:
+                break
+            #Ultimo token del fragmento, o del articulo si termina antes
+            tail = deque(islice(matches, last - first), maxlen=1)
+            end = tail[0] if tail else start
+            read = last + 1
+            pieces.append(' '.join(source[start.start():end.end()].split()))
+        snippet = '...'.join(pieces)
+        if pieces and fragments[0][0] > 0:
+            snippet = '...' + snippet
+        if pieces and next(matches, None) is not None:
+            snippet += '...'
         return snippet
-        
+
 
     def rank_result(self, result, query):
         """
@@ -904,16 +2327,140 @@ class SAR_Project:
 
         Ordena los resultados de una query.
 
+        Las noticias se puntuan con BM25 sobre los terminos de la query que no estan negados,
+        usando las frecuencias de self.weight y las longitudes de self.doclen.
+        Si no se muestran todos los resultados solo se ordenan los self.SHOW_MAX mejores,
+        con un heap acotado en lugar de ordenar la lista entera.
+
         param:  "result": lista de resultados sin ordenar
                 "query": query, puede ser la query original, la query procesada o una lista de terminos
 
 
-        return: la lista de resultados ordenada
+        return: la lista de resultados ordenada, como tuplas (newid, score)
 
         """
+        terms = self.ranking_terms(query)
+        return self.sort_scores(self.bm25_scores(result, terms, self.collection_stats(terms)))
 
-        return []
-        
-        ###################################################
-        ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
-        ###################################################
+
+    def ranking_terms(self, query):
+        """
+        Devuelve los terminos que cuentan para el ranking de una query.
+        param:
+            -query: query original, query procesada o lista de terminos (ver self.rank_result)
+        return:
+            -lista de tuplas (campo, termino, peso). Los terminos de "any:" se reparten entre todos
+             los campos, con el peso de cada campo (self.FIELD_BOOST); el resto tienen peso 1
+        """
+        if isinstance(query, str):
+            tree = self.parse_query(query)
+            terms = self.query_terms(tree) if tree is not None else []
+        else:
+            terms = [('article', t) for t in query]
+        result = []
+        for field, term in terms:
+            if field == self.ANY_FIELD:
+                result.extend((f, term, self.FIELD_BOOST.get(f, 1.0)) for f, tokenize in self.fields)
+            else:
+                result.append((field, term, 1.0))
+        return result
+
+
+    def collection_stats(self, terms):
+        """
+        Estadisticas de la coleccion que usa BM25 para unos terminos.
+        param:
+            -terms: lista de tuplas (campo, termino, peso) de la query (ver self.ranking_terms)
+        return:
+            -tupla (nº de noticias, diccionario campo --> suma de las longitudes de las noticias,
+             diccionario (campo, termino del indice) --> nº de noticias en las que aparece)
+        """
+        total = {field: sum(self.doclen[field]) for field, term, boost in terms if self.doclen.get(field)}
+        df = {}
+        for field, term, boost in terms:
+            for t in self.expand_term(term, field):
+                plist = self.index.get(field, {}).get(t)
+                if plist is not None:
+                    df[(field, t)] = len(plist)
+        return len(self.news), total, df
+
+
+    def bm25_scores(self, result, terms, stats):
+        """
+        Puntua con BM25 las noticias de un resultado.
+        param:
+            -result: posting list con el resultado de la query
+            -terms: lista de tuplas (campo, termino, peso) de la query (ver self.ranking_terms)
+            -stats: estadisticas de la coleccion (ver self.collection_stats)
+        return:
+            -diccionario newid --> puntuacion
+        """
+        N, total, df = stats
+        scores = dict.fromkeys(result, 0.0)
+        for field, term, boost in terms:
+            lens = self.doclen.get(field)
+            if not lens or not total.get(field):
+                continue
+            avgdl = total[field] / N
+            for t in self.expand_term(term, field):
+                plist = self.index[field].get(t)
+                tfs = self.weight.get(field, {}).get(t)
+                if plist is None or tfs is None:
+                    continue
+                n = df[(field, t)]
+                idf = boost * math.log(1 + (N - n + 0.5) / (n + 0.5))
+                for newid, tf in zip(plist, tfs):
+                    if newid in scores:
+                        norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * lens[newid] / avgdl)
+                        scores[newid] += idf * tf * (self.BM25_K1 + 1) / (tf + norm)
+        return scores
+
+
+    def sort_scores(self, scores):
+        """
+        Ordena las noticias puntuadas. Si no se muestran todos los resultados solo se ordenan
+        las self.SHOW_MAX mejores.
+        param:
+            -scores: diccionario newid --> puntuacion
+        return:
+            -lista de tuplas (newid, score)
+        """
+        #Mayor puntuacion primero, a igual puntuacion menor newid primero
+        key = lambda item: (item[1], -item[0])
+        if self.show_all:
+            return sorted(scores.items(), key=key, reverse=True)
+        return heapq.nlargest(self.SHOW_MAX, scores.items(), key=key)
+
+
+    def query_terms(self, node):
+        """
+        Devuelve los terminos de la query que cuentan para el ranking: todos los que no estan negados.
+        param:
+            -node: nodo del arbol de la query (ver self.parse_query)
+        return:
+            -lista de tuplas (campo, termino)
+        """
+        if node[0] == 'term':
+            return [(node[1], node[2])]
+        if node[0] == 'phrase':
+            return [(node[1], t) for t in node[2]]
+        if node[0] in ('not', 'range'):
+            return []
+        return self.query_terms(node[1]) + self.query_terms(node[2])
+
+
+    def expand_term(self, term, field='article'):
+        """
+        Devuelve los terminos del indice a los que corresponde un termino de la query,
+        aplicando el permuterm o el stemming igual que self.get_posting.
+        param:
+            -term: termino de la query
+            -field: campo del indice
+        return:
+            -lista de terminos del indice
+        """
+        if ('*' in term or '?' in term) and self.permuterm:
+            return self.obtener_claves_permu(term, field)
+        if self.use_stemming:
+            return self.sindex.get(field, {}).get(self.stem(term), [])
+        return [term]
@@ -0,0 +1,155 @@
+from collections import Counter
+import cProfile
+import json
+import time
+
+
+# metodos de SAR_Project que empiezan una medida nueva (una query o una indexacion)
+ENTRIES = ('index_dir', 'index_list', 'update_dir', 'solve_query', 'solve_and_count', 'solve_and_show', 'solve_batch')
+
+# etapas que se miden dentro de cada medida. El valor es la funcion que calcula cuanto se suma a cada contador
+# a partir de los argumentos y el resultado de la llamada, None si solo se mide el tiempo
+MERGE = lambda args, res: {'merges': 1, 'merge_input': len(args[0]) + len(args[1])}
+STAGES = {
+    'index_file': lambda args, res: {'files_opened': 1},
+    'tokenize': lambda args, res: {'tokens': len(res)},
+    'merge_index': None,
+    'make_stemming': None,
+    'make_permuterm': None,
+    'make_bitmaps': None,
+    'parse_query': None,
+    'optimize_query': None,
+    'get_posting': None,
+    'get_any_posting': None,
+    'get_term_posting': lambda args, res: {'postings_touched': len(res)},
+    'get_stemming': None,
+    'get_permuterm': None,
+    'obtener_claves_permu': lambda args, res: {'permuterm_terms': len(res)},
+    'get_positionals': None,
+    'and_posting': MERGE,
+    'or_posting': MERGE,
+    'minus_posting': MERGE,
+    'reverse_posting': None,
+    'rank_result': None,
+    'get_new': lambda args, res: {'docs_loaded': 1},
+    'read_day_news': lambda args, res: {'files_opened': 1},
+    'open_docstore': lambda args, res: {'files_opened': 1},
+    'open_docreader': lambda args, res: {'files_opened': 1},
+    'get_summary': None,
+}
+
+
+class Profiler:
+    """
+    Tiempos y contadores por etapa de cada query (o indexacion) de un SAR_Project.
+
+    SAR_Project.set_profile sustituye en la instancia los metodos de ENTRIES y STAGES por versiones
+    que miden su tiempo, asi cuando no se usa el profiler no hay ningun coste: la clase no cambia.
+    Los tiempos de cada etapa incluyen los de las etapas que llama (get_posting incluye get_stemming).
+    """
+
+    def __init__(self, cprofile=False):
+        """
+        param:
+            -cprofile: si es True tambien se ejecutan las medidas con cProfile, para guardarlas con self.dump
+        """
+        self.records = [] # una medida por query: diccionario con la llamada, su argumento, el tiempo, etapas y contadores
+        self.current = None
+        self.depth = 0 # nivel de anidamiento de las llamadas de ENTRIES, solo la mas externa empieza una medida
+        self.cprofile = cProfile.Profile() if cprofile else None
+
+
+    def entry(self, name, method):
+        """
+        Devuelve "method" envuelto para que empiece una medida nueva, salvo si ya hay una en curso.
+        """
+        def run(*args, **kwargs):
+            if self.depth:
+                return self.stage(name, method)(*args, **kwargs)
+            arg = args[0] if args else None
+            self.current = {'call': name, 'arg': arg if isinstance(arg, str) else repr(arg)[:200],
+                            'time_s': 0.0, 'stages': {}, 'counters': Counter()}
+            self.depth += 1
+            if self.cprofile is not None:
+                self.cprofile.enable()
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.current['time_s'] = time.perf_counter() - t0
+                if self.cprofile is not None:
+                    self.cprofile.disable()
+                self.depth -= 1
+                self.records.append(self.current)
+                self.current = None
+        return run
+
+
+    def stage(self, name, method, counter=None):
+        """
+        Devuelve "method" envuelto para que sume su tiempo (y sus contadores) a la etapa "name" de la medida en curso.
+        Fuera de una medida se llama sin medir.
+        """
+        def run(*args, **kwargs):
+            record = self.current
+            if record is None:
+                return method(*args, **kwargs)
+            t0 = time.perf_counter()
+            res = method(*args, **kwargs)
+            stage = record['stages'].setdefault(name, {'calls': 0, 'time_s': 0.0})
+            stage['calls'] += 1
+            stage['time_s'] += time.perf_counter() - t0
+            if counter is not None:
+                record['counters'].update(counter(args, res))
+            return res
+        return run
+
+
+    def summary(self):
+        """
+        Suma las etapas y contadores de todas las medidas.
+        return:
+            -tupla (diccionario etapa --> {'calls', 'time_s'}, diccionario contador --> valor)
+        """
+        stages = {}
+        counters = Counter()
+        for record in self.records:
+            for name, stage in record['stages'].items():
+                total = stages.setdefault(name, {'calls': 0, 'time_s': 0.0})
+                total['calls'] += stage['calls']
+                total['time_s'] += stage['time_s']
+            counters.update(record['counters'])
+        return stages, counters
+
+
+    def show(self):
+        """
+        Muestra el resumen de todas las medidas, las etapas de mayor a menor tiempo.
+        """
+        stages, counters = self.summary()
+        print("="*40)
+        print("Profiled calls: ", len(self.records))
+        print("Total time: %.4fs" % sum(record['time_s'] for record in self.records))
+        print("-"*40)
+        print("%-22s %8s %12s" % ('stage', 'calls', 'time(ms)'))
+        for name, stage in sorted(stages.items(), key=lambda item: item[1]['time_s'], reverse=True):
+            print("%-22s %8d %12.3f" % (name, stage['calls'], stage['time_s'] * 1e3))
+        print("-"*40)
+        for name, value in sorted(counters.items()):
+            print("%-22s %8d" % (name, value))
+        print("="*40)
+
+
+    def dump(self, filename):
+        """
+        Guarda las medidas en "filename": en JSON si termina en .json, si no el informe de cProfile,
+        que se lee con pstats (python -m pstats filename).
+        """
+        if filename.endswith('.json'):
+            stages, counters = self.summary()
+            with open(filename, 'w') as fh:
+                json.dump({'records': self.records, 'stages': stages, 'counters': counters}, fh, indent=2)
+        elif self.cprofile is not None:
+            self.cprofile.dump_stats(filename)
+        else:
+            raise ValueError("cProfile was not enabled, cannot write '%s'" % filename)
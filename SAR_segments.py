@@ -0,0 +1,535 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import threading
+
+from SAR_docstore import DocStoreWriter
+from SAR_lib import Bitmap, SAR_Project, POSTING_TYPE
+from SAR_storage import load_index, save_index
+
+
+def open_index(path):
+    """
+    Abre un indice para buscar: un directorio es un indice por segmentos, si no se carga con load_index
+    (formato binario o pickle antiguo).
+    param:
+        -path: fichero o directorio del indice
+    return:
+        -SAR_Project o SegmentedIndex
+    """
+    if os.path.isdir(path):
+        return SegmentedIndex(path)
+    return load_index(path)
+
+
+# segmentos de cada proceso de SegmentedIndex.solve_segments_parallel
+batch_segments = None
+
+
+def init_segments(segments):
+    """
+    Inicializa un proceso de SegmentedIndex.solve_segments_parallel con los segmentos en los que se busca.
+    """
+    global batch_segments
+    batch_segments = segments
+
+
+def solve_segment_chunk(i, queries):
+    """
+    Resuelve un grupo de queries en el segmento i, en un proceso de SegmentedIndex.solve_segments_parallel.
+    Las posting lists leidas del segmento proyectado en memoria (memoryview) se copian para poder devolverlas.
+    """
+    return [p if isinstance(p, (array, Bitmap)) else array(POSTING_TYPE, p) for p in batch_segments[i].solve_batch(queries)]
+
+
+class SegmentedIndex(SAR_Project):
+    """
+    Indice formado por segmentos inmutables guardados en un directorio.
+
+    Cada vez que se indexan ficheros nuevos se crea un segmento nuevo (un SAR_Project guardado con
+    save_index) con newIDs locales que empiezan en 1. El newID global de una noticia es el de su segmento
+    mas el nº de noticias de los segmentos anteriores, asi las posting lists de los segmentos se
+    concatenan en orden sin tener que ordenarlas.
+
+    La lista de segmentos se guarda en el fichero "manifest.json" del directorio, que se sustituye
+    de forma atomica. Un hilo en segundo plano fusiona los segmentos nuevos con los anteriores cuando
+    estos no son bastante mas grandes (ver self.pick_merge), con lo que el nº de segmentos es logaritmico
+    en el nº de noticias y nunca hay que reconstruir el indice entero para añadir noticias. Mientras tanto
+    las consultas siguen usando los segmentos anteriores, que no se modifican nunca.
+
+    Puede haber muchos procesos consultando el indice pero solo uno escribiendo: el manifest se escribe
+    a partir de los segmentos en memoria, sin bloquearlo. Si otro proceso lo cambia, al crear o guardar
+    un segmento se lanza RuntimeError (ver self.check_writer) en lugar de perder sus segmentos.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    # cada segmento tiene que tener mas de MERGE_RATIO veces las noticias de todos los posteriores juntos,
+    # si no se fusiona con ellos
+    MERGE_RATIO = 1
+
+    # opciones de indexacion que se guardan en el manifest, todos los segmentos se crean con las mismas
+    OPTIONS = ('multifield', 'positional', 'stem', 'permuterm', 'stem_postings', 'docstore')
+
+
+    def __init__(self, path, **args):
+        """
+        Abre el indice del directorio "path", o lo crea vacio si no existe.
+        param:
+            -path: directorio del indice
+            -args: opciones de indexacion (las de SAR_Project.index_dir), solo se usan al crear el indice.
+                   "docstore" indica si cada segmento guarda sus noticias en un almacen
+        """
+        super().__init__()
+        self.path = path
+        self.lock = threading.RLock()
+        self.merger = None # hilo de fusion de segmentos, si esta en marcha
+        self.mtime = None # fecha de modificacion del manifest leido
+        #Segmentos en uso: (newIDs iniciales, nombres, SAR_Project). Se sustituye entero al cambiar
+        self.view = ([], [], [])
+        manifest = os.path.join(path, self.MANIFEST)
+        if not os.path.exists(manifest):
+            os.makedirs(path, exist_ok=True)
+            self.options = {option: bool(args.get(option)) for option in self.OPTIONS}
+            self.next = 1
+            self.write_manifest([])
+        self.refresh()
+        self.multifield = self.options['multifield']
+        self.positional = self.options['positional']
+        self.stemming = self.options['stem']
+        self.permuterm = self.options['permuterm']
+        self.set_stemming(self.stemming)
+
+
+    def set_profile(self, profiler):
+        """
+        Activa o desactiva la medida de tiempos en el indice y en todos sus segmentos.
+        """
+        super().set_profile(profiler)
+        for segment in self.view[2]:
+            segment.set_profile(profiler)
+
+
+    def segment_path(self, name):
+        return os.path.join(self.path, name)
+
+
+    def load_segment(self, name):
+        """
+        Carga un segmento del directorio del indice. Sus posting lists se leen con mmap.
+        """
+        segment = load_index(self.segment_path(name))
+        segment.name = name
+        return segment
+
+
+    def write_manifest(self, segments):
+        """
+        Guarda la lista de segmentos en el manifest, escribiendo un fichero temporal que despues lo sustituye.
+        param:
+            -segments: lista de (nombre, nº de noticias) de cada segmento, en orden
+        """
+        manifest = os.path.join(self.path, self.MANIFEST)
+        with open(manifest + '.tmp', 'w') as fh:
+            json.dump({'options': self.options, 'next': self.next,
+                       'segments': [[name, news] for name, news in segments]}, fh)
+        os.replace(manifest + '.tmp', manifest)
+
+
+    def refresh(self):
+        """
+        Vuelve a leer el manifest si ha cambiado (por ejemplo lo ha actualizado otro proceso que indexa)
+        y carga los segmentos nuevos. Los segmentos que ya estaban cargados se reutilizan.
+        """
+        manifest = os.path.join(self.path, self.MANIFEST)
+        with self.lock:
+            while True:
+                mtime = os.stat(manifest).st_mtime_ns
+                if mtime == self.mtime:
+                    return
+                with open(manifest) as fh:
+                    data = json.load(fh)
+                loaded = dict(zip(self.view[1], self.view[2]))
+                try:
+                    segments = [loaded.get(name) or self.load_segment(name) for name, news in data['segments']]
+                except FileNotFoundError:
+                    #Una fusion ha borrado el segmento despues de leer el manifest, se vuelve a leer
+                    continue
+                self.options = data['options']
+                self.next = data['next']
+                self.mtime = mtime
+                self.set_view(segments)
+
+
+    def set_view(self, segments):
+        """
+        Cambia los segmentos en uso.
+        param:
+            -segments: lista de SAR_Project, en orden
+        """
+        bases = []
+        names = []
+        base = 0
+        for segment in segments:
+            bases.append(base)
+            names.append(segment.name)
+            base += len(segment.news)
+        self.view = (bases, names, segments)
+        self.version += 1
+        for segment in segments:
+            if segment.profiler is not self.profiler:
+                segment.set_profile(self.profiler)
+
+
+    ###############################
+    ###                         ###
+    ###       INDEXACION        ###
+    ###                         ###
+    ###############################
+
+
+    def add_dir(self, root, jobs=1):
+        """
+        Crea un segmento nuevo con los ficheros de "root" que no estan aun en el indice.
+        param:
+            -root: directorio con las noticias
+            -jobs: nº de procesos para indexar
+        return:
+            -nº de ficheros nuevos indexados
+        """
+        known = {os.path.normpath(filename) for segment in self.view[2] for filename in segment.docs.values()}
+        filenames = [f for f in self.list_files(root) if os.path.normpath(f) not in known]
+        if filenames:
+            self.add_segment(filenames, jobs)
+        return len(filenames)
+
+
+    def add_segment(self, filenames, jobs=1):
+        """
+        Indexa una lista de ficheros en un segmento nuevo, que se añade al final del indice,
+        y lanza la fusion de segmentos si hace falta.
+        param:
+            -filenames: lista de ficheros a indexar
+            -jobs: nº de procesos para indexar
+        """
+        with self.lock:
+            name = self.new_name()
+        segment = SAR_Project()
+        segment.set_profile(self.profiler)
+        filename = self.segment_path(name)
+        segment.index_list(filenames, jobs=jobs, docstore=filename + '.docs' if self.options['docstore'] else None,
+                           **{k: v for k, v in self.options.items() if k != 'docstore'})
+        segment = self.save_segment(segment, name)
+        with self.lock:
+            self.commit(self.view[2] + [segment])
+        self.start_merge()
+
+
+    def check_writer(self):
+        """
+        Solo se admite un proceso escribiendo: si el manifest ha cambiado desde la ultima vez que se leyo
+        o escribio, lo ha escrito otro proceso y no se puede crear ni guardar ningun segmento.
+        Se llama con self.lock cogido.
+        """
+        manifest = os.path.join(self.path, self.MANIFEST)
+        if os.stat(manifest).st_mtime_ns != self.mtime:
+            raise RuntimeError("'%s' was changed by another process, only one writer is supported" % manifest)
+
+
+    def new_name(self):
+        #Antes de escribir el segmento, para no sobreescribir uno de otro proceso con el mismo nombre
+        self.check_writer()
+        name = 'seg%06d.bin' % self.next
+        self.next += 1
+        return name
+
+
+    def save_segment(self, segment, name):
+        """
+        Guarda un segmento y lo vuelve a cargar del fichero, asi sus posting lists se leen con mmap.
+        """
+        save_index(segment, self.segment_path(name))
+        return self.load_segment(name)
+
+
+    def commit(self, segments):
+        """
+        Guarda en el manifest y pone en uso una nueva lista de segmentos. Se llama con self.lock cogido.
+        """
+        self.check_writer()
+        self.write_manifest([(segment.name, len(segment.news)) for segment in segments])
+        self.mtime = os.stat(os.path.join(self.path, self.MANIFEST)).st_mtime_ns
+        self.set_view(segments)
+
+
+    def pick_merge(self, sizes):
+        """
+        Politica de fusion por proporcion de tamaños: cada segmento tiene que tener mas de self.MERGE_RATIO
+        veces las noticias de todos los posteriores juntos. El mas antiguo que no lo cumple se fusiona con
+        todos los posteriores, sean del tamaño que sean. Asi (con MERGE_RATIO >= 1) la suma de los segmentos
+        posteriores a cada uno es menos de la mitad de la del anterior y hay como mucho log2(nº de noticias) + 1
+        segmentos. Solo se fusionan segmentos consecutivos para que los newIDs no cambien.
+        param:
+            -sizes: nº de noticias de cada segmento
+        return:
+            -tupla (posicion del primer segmento, posicion del ultimo + 1) a fusionar, o None si no hay que fusionar
+        """
+        first = None
+        newer = 0
+        for i in range(len(sizes) - 1, -1, -1):
+            if newer and sizes[i] <= self.MERGE_RATIO * newer:
+                first = i
+            newer += sizes[i]
+        if first is None:
+            return None
+        return first, len(sizes)
+
+
+    def start_merge(self):
+        """
+        Lanza el hilo de fusion de segmentos si no esta ya en marcha.
+        """
+        with self.lock:
+            if self.merger is None or not self.merger.is_alive():
+                self.merger = threading.Thread(target=self.merge_segments, daemon=True)
+                self.merger.start()
+
+
+    def merge_segments(self):
+        """
+        Fusiona segmentos mientras la politica de fusion encuentre alguno.
+        Los segmentos fusionados se sustituyen en el manifest por el nuevo y despues se borran.
+        """
+        while True:
+            with self.lock:
+                segments = self.view[2]
+                picked = self.pick_merge([len(segment.news) for segment in segments])
+                if picked is None:
+                    return
+                i, j = picked
+                group = segments[i:j]
+                name = self.new_name()
+            merged = self.merge_group(group, name)
+            with self.lock:
+                #Mientras se fusionaba solo se han podido añadir segmentos al final
+                segments = self.view[2]
+                self.commit(segments[:i] + [merged] + segments[j:])
+            for segment in group:
+                for filename in (self.segment_path(segment.name), segment.docstore):
+                    if filename is not None and os.path.exists(filename):
+                        os.remove(filename)
+
+
+    def merge_group(self, group, name):
+        """
+        Fusiona una lista de segmentos consecutivos en uno nuevo.
+        param:
+            -group: lista de SAR_Project, en orden
+            -name: nombre del segmento nuevo
+        return:
+            -el segmento nuevo, ya guardado y cargado
+        """
+        merged = SAR_Project()
+        merged.multifield = self.multifield
+        merged.positional = self.positional
+        merged.stemming = self.stemming
+        merged.permuterm = self.permuterm
+        merged.stem_postings = self.options['stem_postings']
+        merged.set_stemming(self.stemming)
+        writer = None
+        if self.options['docstore']:
+            merged.docstore = self.segment_path(name) + '.docs'
+            open(merged.docstore, 'wb').close()
+            writer = DocStoreWriter(merged.docstore, merged.doc_offsets)
+        for segment in group:
+            #merge_index no añade el almacen porque merged.docwriter es None, asi no se borra el del segmento
+            merged.merge_index(segment)
+            if writer is not None:
+                writer.add_store(segment.docstore, segment.doc_offsets)
+        if writer is not None:
+            writer.close()
+        merged.make_secondary()
+        return self.save_segment(merged, name)
+
+
+    def wait(self):
+        """
+        Espera a que termine la fusion de segmentos en marcha.
+        """
+        merger = self.merger
+        if merger is not None:
+            merger.join()
+
+
+    ###############################
+    ###                         ###
+    ###      RECUPERACION       ###
+    ###                         ###
+    ###############################
+
+
+    def solve_query(self, query, prev={}):
+        """
+        Resuelve la query en cada segmento y concatena los resultados con los newIDs globales.
+        Tanto el resultado global como los de cada segmento se guardan en las caches de queries.
+        param:
+            -query: cadena con la query
+        return:
+            -posting list con el resultado de la query
+        """
+        self.refresh()
+        node = self.query_node(query)
+        if node is None:
+            return array(POSTING_TYPE)
+        #La version cambia al cambiar los segmentos, asi no se devuelven resultados de una vista anterior
+        cache = self.get_query_cache()
+        result = cache.get(node)
+        if result is not None:
+            return result
+        result = array(POSTING_TYPE)
+        for base, segment in zip(self.view[0], self.view[2]):
+            segment.use_stemming = self.use_stemming
+            result.extend([newid + base for newid in segment.eval_query(node, segment.get_query_cache())])
+        cache[node] = result
+        return result
+
+
+    def solve_batch(self, queries, jobs=1):
+        """
+        Resuelve una lista de queries con SAR_Project.solve_batch en cada segmento
+        y concatena los resultados de cada query con los newIDs globales.
+        Igual que en self.solve_query, los resultados globales se buscan y se guardan en la cache de queries.
+        """
+        self.refresh()
+        return self.cached_batch(queries, lambda pending: self.solve_segments(pending, jobs))
+
+
+    def solve_segments(self, queries, jobs=1):
+        """
+        Resuelve las queries en todos los segmentos, sin pasar por la cache global (ver self.solve_batch).
+        """
+        bases, names, segments = self.view
+        for segment in segments:
+            segment.use_stemming = self.use_stemming
+        if jobs > 1 and len(queries) * len(segments) > 1:
+            partial = self.solve_segments_parallel(segments, queries, jobs)
+        else:
+            partial = [segment.solve_batch(queries) for segment in segments]
+        results = [array(POSTING_TYPE) for query in queries]
+        for base, local in zip(bases, partial):
+            for result, plist in zip(results, local):
+                result.extend([newid + base for newid in plist])
+        return results
+
+
+    def solve_segments_parallel(self, segments, queries, jobs):
+        """
+        Reparte entre "jobs" procesos, con un unico pool para todo el lote, la resolucion de las queries
+        en cada segmento: cada tarea es un grupo de queries consecutivas en un segmento.
+        Cada proceso recibe los segmentos al arrancar (con fork no se copian, se heredan).
+        return:
+            -lista con los resultados de cada segmento, con sus newIDs locales
+        """
+        #Grupos por segmento para tener al menos "jobs" tareas
+        nchunks = min(len(queries), -(-jobs // len(segments)))
+        size = -(-len(queries) // nchunks)
+        tasks = [(i, start) for i in range(len(segments)) for start in range(0, len(queries), size)]
+        partial = [[] for segment in segments]
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=init_segments,
+                                 initargs=(segments,)) as executor:
+            #map devuelve los resultados en el orden de las tareas
+            parts = executor.map(solve_segment_chunk, [i for i, start in tasks],
+                                 [queries[start:start + size] for i, start in tasks])
+            for (i, start), part in zip(tasks, parts):
+                partial[i].extend(part)
+        return partial
+
+
+    def locate(self, newid):
+        """
+        Devuelve el segmento de una noticia y su newID dentro del segmento.
+        """
+        bases, names, segments = self.view
+        i = bisect_left(bases, newid) - 1
+        return segments[i], newid - bases[i]
+
+
+    def get_new(self, newid):
+        segment, newid = self.locate(newid)
+        return segment.get_new(newid)
+
+
+    def get_news(self, newids):
+        """
+        Devuelve varias noticias, leyendo con SAR_Project.get_news las de cada segmento de una vez.
+        """
+        local = {}
+        for newid in newids:
+            segment, aux = self.locate(newid)
+            local.setdefault(id(segment), (segment, []))[1].append((newid, aux))
+        found = {}
+        for segment, aux in local.values():
+            found.update(zip([newid for newid, i in aux], segment.get_news([i for newid, i in aux])))
+        return [found[newid] for newid in newids]
+
+
+    def term_positions(self, terms, newid, field='article'):
+        segment, newid = self.locate(newid)
+        return segment.term_positions(terms, newid, field)
+
+
+    def rank_result(self, result, query):
+        """
+        Ordena los resultados con BM25 usando las estadisticas de todos los segmentos,
+        asi las puntuaciones son las mismas que con un unico indice.
+        """
+        terms = self.ranking_terms(query)
+        stats = self.collection_stats(terms)
+        bases, names, segments = self.view
+        scores = {}
+        for base, segment in zip(bases, segments):
+            #El resultado esta ordenado, las noticias de cada segmento son consecutivas
+            start = bisect_right(result, base)
+            end = bisect_right(result, base + len(segment.news))
+            local = segment.bm25_scores([newid - base for newid in result[start:end]], terms, stats)
+            scores.update((newid + base, score) for newid, score in local.items())
+        return self.sort_scores(scores)
+
+
+    def collection_stats(self, terms):
+        N = 0
+        total = Counter()
+        df = Counter()
+        for segment in self.view[2]:
+            n, t, d = segment.collection_stats(terms)
+            N += n
+            total.update(t)
+            df.update(d)
+        return N, total, df
+
+
+    def expand_term(self, term, field='article'):
+        return sorted({t for segment in self.view[2] for t in segment.expand_term(term, field)})
+
+
+    def obtener_claves_permu(self, term, field='article'):
+        return sorted({t for segment in self.view[2] for t in segment.obtener_claves_permu(term, field)})
+
+
+    def show_stats(self):
+        """
+        Muestra los segmentos del indice y el total de noticias.
+        """
+        bases, names, segments = self.view
+        print("="*40)
+        print("Number of segments: ", len(segments))
+        for name, segment in zip(names, segments):
+            print("  %s: %d days, %d news" % (name, len(segment.docs), len(segment.news)))
+        print("-"*40)
+        print("Number of indexed days: ", sum(len(segment.docs) for segment in segments))
+        print("-"*40)
+        print("Number of indexed news ", sum(len(segment.news) for segment in segments))
+        print("="*40)
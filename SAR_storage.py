@@ -0,0 +1,280 @@
+from array import array
+from collections.abc import Mapping, Sequence
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+from SAR_lib import POSTING_TYPE
+
+
+# cabecera del formato binario: firma, version, orden de bytes de las posting lists,
+# posicion y longitud del diccionario de terminos y posicion y longitud del resto del objeto.
+# Ocupa 48 bytes, asi las posting lists que van detras quedan alineadas para hacer cast del memoryview
+MAGIC = b'SARIDX'
+VERSION = 1
+HEADER = struct.Struct('<6sHB7xQQQQ')
+FORMATS = ('mmap', 'pickle')
+# atributos de SAR_Project que se proyectan en memoria en vez de guardarse con pickle
+MAPPED = ('index', 'weight', 'pindex', 'ptindex')
+
+
+class MappedPostings(Mapping):
+    """
+    Diccionario termino --> posting list de un campo cuyas posting lists se leen bajo demanda
+    de un fichero proyectado en memoria (mmap).
+
+    Solo se cargan en memoria el termino y la posicion de su posting list. Cada acceso devuelve
+    un memoryview de solo lectura sobre el fichero, por lo que solo se leen las paginas que se usan.
+    """
+
+    def __init__(self, data, keys, offsets, lens):
+        """
+        param:
+            -data: memoryview con todas las posting lists del fichero
+            -keys: lista de terminos del campo, o diccionario termino --> posicion de otro
+                   MappedPostings con los mismos terminos (se comparte)
+            -offsets, lens: arrays con la posicion (en elementos) y la longitud de cada posting list
+        """
+        self.data = data
+        self.terms = keys if isinstance(keys, dict) else {t: i for i, t in enumerate(keys)}
+        self.offsets = offsets
+        self.lens = lens
+
+
+    def __getitem__(self, term):
+        i = self.terms[term]
+        off = self.offsets[i]
+        return self.data[off:off + self.lens[i]]
+
+
+    def __contains__(self, term):
+        return term in self.terms
+
+
+    def __iter__(self):
+        return iter(self.terms)
+
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class MappedPositions(Mapping):
+    """
+    Indice posicional de un campo (termino --> (offsets, posiciones), ver SAR_Project.process_positions)
+    leido bajo demanda de un fichero proyectado en memoria. Cada acceso devuelve dos memoryview:
+    donde empiezan las posiciones de cada noticia y las posiciones codificadas.
+    Con pickle se guarda como el diccionario en memoria equivalente.
+    """
+
+    def __init__(self, offsets, positions):
+        """
+        param:
+            -offsets: MappedPostings con el offset de cada noticia en las posiciones del termino
+            -positions: MappedPostings, con los mismos terminos, con las posiciones codificadas
+        """
+        self.offsets = offsets
+        self.positions = positions
+
+
+    def __getitem__(self, term):
+        return self.offsets[term], self.positions[term]
+
+
+    def __contains__(self, term):
+        return term in self.offsets
+
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+    def __reduce__(self):
+        return dict, ({t: (array('I', offsets), bytearray(positions)) for t, (offsets, positions) in self.items()},)
+
+
+class MappedStrings(Sequence):
+    """
+    Lista ordenada de cadenas (las rotaciones del indice permuterm) leida bajo demanda de un fichero
+    proyectado en memoria. Solo se decodifican las cadenas a las que se accede, asi una busqueda
+    binaria (bisect) solo lee unas pocas. Con pickle se guarda como la lista equivalente.
+    """
+
+    def __init__(self, data, offsets):
+        """
+        param:
+            -data: memoryview con los bytes de las cadenas en UTF-8, una detras de otra
+            -offsets: array con la posicion de cada cadena en "data" y, al final, la del final de la ultima
+        """
+        self.data = data
+        self.offsets = offsets
+
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string index out of range')
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+def save_index(project, filename, fmt='mmap'):
+    """
+    Guarda un SAR_Project en disco.
+    Se escribe en un fichero temporal que despues sustituye al indice, asi quien tenga abierto
+    (o proyectado en memoria) el indice anterior lo sigue leyendo entero.
+    param:
+        -project: SAR_Project a guardar
+        -filename: fichero de salida
+        -fmt: 'mmap' para el formato binario versionado o 'pickle' para el formato antiguo
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown index format '%s'" % fmt)
+    tmpname = filename + '.tmp'
+    if fmt == 'pickle':
+        with open(tmpname, 'wb') as fh:
+            pickle.dump(project, fh)
+    else:
+        write_mapped(project, tmpname)
+    os.replace(tmpname, filename)
+
+
+def write_lists(fh, start, lists, typecode=POSTING_TYPE):
+    """
+    Escribe una serie de listas una detras de otra.
+    param:
+        -fh: fichero de salida
+        -start: posicion en el fichero del principio de la seccion
+        -lists: listas a escribir
+        -typecode: tipo de array de los elementos ('B' para bytes)
+    return:
+        -tupla (offsets, lens) con la posicion (en elementos, desde "start") y la longitud de cada lista, en bytes
+    """
+    offsets = array('Q')
+    lens = array('I')
+    for values in lists:
+        values = array(typecode, values)
+        offsets.append((fh.tell() - start) // values.itemsize)
+        lens.append(len(values))
+        values.tofile(fh)
+    return offsets.tobytes(), lens.tobytes()
+
+
+def write_mapped(project, filename):
+    """
+    Escribe un SAR_Project en el formato binario con las posting lists proyectables en memoria.
+
+    Detras de la cabecera van dos secciones: una de enteros con las posting lists, las frecuencias
+    (weight) y los offsets del indice posicional (pindex), y otra de bytes con las posiciones
+    codificadas y las rotaciones del indice permuterm (ptindex). Despues el diccionario con la
+    posicion de cada lista y el resto del objeto con pickle.
+    param:
+        -project: SAR_Project a guardar
+        -filename: fichero de salida
+    """
+    with open(filename, 'wb') as fh:
+        #Reservamos la cabecera, se rellena al final
+        fh.write(b'\0' * HEADER.size)
+        dictionary = {'index': {}, 'weight': {}, 'pindex': {}, 'ptindex': {}}
+        #Seccion de enteros. Las frecuencias y los offsets de las posiciones tienen la misma longitud
+        #que la posting list del termino; si tienen los mismos terminos no se guardan otra vez (None)
+        for field, terms in project.index.items():
+            keys = list(terms)
+            offsets, lens = write_lists(fh, HEADER.size, (terms[t] for t in keys))
+            dictionary['index'][field] = (keys, offsets, lens)
+            for name in ('weight', 'pindex'):
+                other = getattr(project, name).get(field)
+                if other is None:
+                    continue
+                other_keys = None if len(other) == len(keys) and all(t in other for t in keys) else list(other)
+                values = (other[t] for t in other_keys or keys)
+                if name == 'pindex':
+                    values = (offs for offs, positions in values)
+                dictionary[name][field] = (other_keys,) + write_lists(fh, HEADER.size, values)
+        #Seccion de bytes
+        bytes_pos = fh.tell()
+        for field, terms in project.pindex.items():
+            if field in dictionary['pindex']:
+                keys = dictionary['pindex'][field][0] or dictionary['index'][field][0]
+                dictionary['pindex'][field] += write_lists(fh, bytes_pos, (terms[t][1] for t in keys), 'B')
+        for field, permus in project.ptindex.items():
+            offsets = array('Q', [fh.tell() - bytes_pos])
+            for permu in permus:
+                fh.write(permu.encode('utf-8'))
+                offsets.append(fh.tell() - bytes_pos)
+            dictionary['ptindex'][field] = offsets.tobytes()
+        dictionary['bytes'] = bytes_pos
+        dict_pos = fh.tell()
+        #El diccionario y el resto del objeto (docs, news, stems...) se guardan con el mismo Pickler,
+        #asi cada termino se guarda una vez y al cargarlo es la misma cadena en todos los indices
+        pickler = pickle.Pickler(fh)
+        pickler.dump(dictionary)
+        meta_pos = fh.tell()
+        saved = {name: getattr(project, name) for name in MAPPED}
+        for name in MAPPED:
+            setattr(project, name, {})
+        try:
+            pickler.dump(project)
+        finally:
+            for name, value in saved.items():
+                setattr(project, name, value)
+        end = fh.tell()
+        fh.seek(0)
+        fh.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little',
+                             dict_pos, meta_pos - dict_pos, meta_pos, end - meta_pos))
+
+
+def load_index(filename):
+    """
+    Carga un SAR_Project guardado con save_index, detectando el formato del fichero.
+    param:
+        -filename: fichero con el indice
+    return:
+        -el SAR_Project cargado
+    """
+    with open(filename, 'rb') as fh:
+        head = fh.read(HEADER.size)
+        if not head.startswith(MAGIC):
+            #Formato antiguo: el objeto entero serializado con pickle
+            fh.seek(0)
+            return pickle.load(fh)
+        magic, version, little, dict_pos, dict_len, meta_pos, meta_len = HEADER.unpack(head)
+        if version != VERSION:
+            raise ValueError("unsupported index version %d in '%s'" % (version, filename))
+        if little != (sys.byteorder == 'little'):
+            raise ValueError("index '%s' was saved with a different byte order" % filename)
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    mm.seek(dict_pos)
+    unpickler = pickle.Unpickler(mm)
+    dictionary = unpickler.load()
+    project = unpickler.load()
+    data = view[HEADER.size:dictionary['bytes']].cast(POSTING_TYPE)
+    text = view[dictionary['bytes']:dict_pos]
+    for field, (keys, offsets, lens) in dictionary['index'].items():
+        project.index[field] = MappedPostings(data, keys, array('Q', offsets), array('I', lens))
+    for field, (keys, offsets, lens) in dictionary['weight'].items():
+        keys = project.index[field].terms if keys is None else keys
+        project.weight[field] = MappedPostings(data, keys, array('Q', offsets), array('I', lens))
+    for field, (keys, offsets, lens, poffsets, plens) in dictionary['pindex'].items():
+        keys = project.index[field].terms if keys is None else keys
+        offsets = MappedPostings(data, keys, array('Q', offsets), array('I', lens))
+        positions = MappedPostings(text, offsets.terms, array('Q', poffsets), array('I', plens))
+        project.pindex[field] = MappedPositions(offsets, positions)
+    for field, offsets in dictionary['ptindex'].items():
+        project.ptindex[field] = MappedStrings(text, array('Q', offsets))
+    return project